@@ -1,8 +1,13 @@
 from __future__ import annotations
 
+import hashlib
+import random
 import re
+import struct
+import zlib
+from array import array
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Any, Dict, List, Optional, Tuple, Set
 from collections import Counter
 
@@ -20,8 +25,31 @@ RU_STOP = set(
 NEG_WORDS = set("плох ужас отврат не работает слом сломал сломалась брак возврат не советую разочар не подошел дешев хлипк воняет запах".split())
 POS_WORDS = set("отлич супер класс понравилось рекомендую качеств хороший красив удобн".split())
 
+# upper bound of reviews one analysis looks at
+MAX_REVIEWS = 4000
+
+# bump whenever heuristics change: persisted analysis results of other versions are ignored
+ANALYZER_VERSION = 3
+
 AGE_PATTERN = re.compile(r"через\s+(\d+)\s*(дн\w*|недел\w*|мес\w*|месяц\w*)", re.I)
 
+# near-duplicate search: MinHash signatures + banded LSH (bands * rows == perms).
+# 8 bands x 4 rows put the LSH threshold at ~0.6, so pairs with jaccard >= 0.8
+# become candidates with probability ~0.98; candidates are then verified exactly.
+NEAR_DUP_THRESHOLD = 0.8
+MINHASH_BANDS = 8
+MINHASH_ROWS = 4
+MINHASH_PERM = MINHASH_BANDS * MINHASH_ROWS
+# distinct clusters a review is checked against per LSH bucket (bounds template-spam buckets)
+LSH_BUCKET_CHECKS = 16
+
+_MASK64 = (1 << 64) - 1
+_MIX64 = 0x9E3779B97F4A7C15
+# fixed seeds -> signatures are stable across processes and restarts
+_seed_rng = random.Random(20240607)
+_MINHASH_SEEDS = [_seed_rng.getrandbits(64) for _ in range(MINHASH_PERM)]
+del _seed_rng
+
 @dataclass
 class Review:
     rating: Optional[int]
@@ -29,6 +57,86 @@ class Review:
     created: Optional[datetime] = None
 
 
+# compact, picklable review form for the process pool: (rating, text, created epoch seconds)
+PackedReview = Tuple[Optional[int], str, Optional[int]]
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def pack_reviews(reviews: List[Review]) -> List[PackedReview]:
+    return [
+        (r.rating, r.text, int((r.created - _EPOCH).total_seconds()) if r.created else None)
+        for r in reviews
+    ]
+
+
+# compact storage form of a review list (replaces the raw WB feedback JSON in the cache):
+#   magic | u32 count | count x u8 rating (255 = none) | count x i64 epoch (min = none)
+#   | count x u32 text length | utf-8 texts back to back          (all little-endian)
+_REVIEWS_MAGIC = b"RV1\0"
+_NO_RATING = 255
+_NO_DATE = -(1 << 63)
+
+
+def encode_reviews(reviews: List[Review]) -> bytes:
+    packed = pack_reviews(reviews)
+    ratings = bytes(
+        r if r is not None and 0 <= r < _NO_RATING else _NO_RATING for r, _, _ in packed
+    )
+    dates = array("q", (ts if ts is not None else _NO_DATE for _, _, ts in packed))
+    texts = [t.encode("utf-8") for _, t, _ in packed]
+    lengths = array("I", (len(t) for t in texts))
+    if struct.pack("<H", 1) != struct.pack("=H", 1):  # arrays are native-endian
+        dates.byteswap()
+        lengths.byteswap()
+    return b"".join(
+        [_REVIEWS_MAGIC, struct.pack("<I", len(packed)), ratings, dates.tobytes(), lengths.tobytes(), *texts]
+    )
+
+
+def decode_reviews(blob: bytes) -> List[Review]:
+    if blob[:4] != _REVIEWS_MAGIC:
+        raise ValueError("not an encoded review list")
+    (n,) = struct.unpack_from("<I", blob, 4)
+    pos = 8
+    ratings = blob[pos:pos + n]
+    pos += n
+    dates = array("q")
+    dates.frombytes(blob[pos:pos + 8 * n])
+    pos += 8 * n
+    lengths = array("I")
+    lengths.frombytes(blob[pos:pos + 4 * n])
+    pos += 4 * n
+    if struct.pack("<H", 1) != struct.pack("=H", 1):
+        dates.byteswap()
+        lengths.byteswap()
+    packed: List[PackedReview] = []
+    for i in range(n):
+        end = pos + lengths[i]
+        packed.append((
+            None if ratings[i] == _NO_RATING else ratings[i],
+            blob[pos:end].decode("utf-8"),
+            None if dates[i] == _NO_DATE else dates[i],
+        ))
+        pos = end
+    return unpack_reviews(packed)
+
+
+def reviews_digest(reviews: List[Review]) -> str:
+    """Content hash of the analyzer input (ratings, dates, texts)."""
+    h = hashlib.blake2b(digest_size=16)
+    for rating, text, ts in pack_reviews(reviews):
+        h.update(f"{rating}\x1f{ts}\x1f{text}\x1e".encode("utf-8"))
+    return h.hexdigest()
+
+
+def unpack_reviews(packed: List[PackedReview]) -> List[Review]:
+    return [
+        Review(rating=rating, text=text, created=_EPOCH + timedelta(seconds=ts) if ts is not None else None)
+        for rating, text, ts in packed
+    ]
+
+
 def _to_datetime(x: Any) -> Optional[datetime]:
     if not x:
         return None
@@ -53,7 +161,7 @@ def extract_reviews(feedback_json: Dict[str, Any]) -> List[Review]:
         candidates = feedback_json["data"]["feedbacksWithText"]
 
     reviews: List[Review] = []
-    for it in candidates[:4000]:
+    for it in candidates[:MAX_REVIEWS]:
         if not isinstance(it, dict):
             continue
         rating = it.get("productValuation") or it.get("valuation") or it.get("rating") or it.get("stars")
@@ -105,48 +213,125 @@ def jaccard(a: Set[str], b: Set[str]) -> float:
     return inter / union if union else 0.0
 
 
-def _has_neg(text: str) -> bool:
-    toks = set(tokenize(text))
-    return any(w in toks for w in NEG_WORDS)
+def minhash_signature(sh: Set[str]) -> Tuple[int, ...]:
+    """MinHash of a shingle set: per-seed minimum of XOR-permuted 64-bit shingle hashes."""
+    hs = [(zlib.crc32(x.encode("utf-8")) * _MIX64) & _MASK64 for x in sh]
+    return tuple(min([h ^ seed for h in hs]) for seed in _MINHASH_SEEDS)
 
 
-def _has_pos(text: str) -> bool:
-    toks = set(tokenize(text))
-    return any(w in toks for w in POS_WORDS)
+def near_duplicates(sh_list: List[Set[str]], threshold: float = NEAR_DUP_THRESHOLD) -> Tuple[int, List[int]]:
+    """Near-duplicate clusters over ALL reviews via MinHash + LSH.
 
+    Returns (number of near-duplicate pairs, cluster id per review). Identical
+    shingle sets are collapsed first; within an LSH bucket a set is checked only
+    against up to LSH_BUCKET_CHECKS representatives of clusters not yet joined,
+    so template spam (everything in one bucket) stays linear. Pairs are counted
+    from cluster sizes, i.e. near-duplication is treated as transitive.
+    """
+    n = len(sh_list)
+    rep = list(range(n))
 
-def trust_score_details(reviews: List[Review]) -> Tuple[int, List[str], Dict[str, float], Dict[str, int]]:
-    """Return: (score 0..100, reasons, signals, penalties_by_factor)."""
+    def find(x: int) -> int:
+        while rep[x] != x:
+            rep[x] = rep[rep[x]]
+            x = rep[x]
+        return x
+
+    def union(a: int, b: int) -> None:
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            rep[rb] = ra
+
+    # collapse identical sets: they are pairwise jaccard 1.0
+    uniq: Dict[frozenset, List[int]] = {}
+    for i, sh in enumerate(sh_list):
+        if sh:  # jaccard of empty sets is 0 -> never a near duplicate
+            uniq.setdefault(frozenset(sh), []).append(i)
+    sets = list(uniq.keys())
+    heads = []
+    for idxs in uniq.values():
+        heads.append(idxs[0])
+        for i in idxs[1:]:
+            union(idxs[0], i)
+
+    # banded LSH over distinct sets -> candidates -> exact check against cluster representatives
+    buckets: Dict[Tuple[int, Tuple[int, ...]], List[int]] = {}
+    for u, sh in enumerate(sets):
+        sig = minhash_signature(sh)
+        for b in range(MINHASH_BANDS):
+            buckets.setdefault((b, sig[b * MINHASH_ROWS:(b + 1) * MINHASH_ROWS]), []).append(u)
+
+    for us in buckets.values():
+        if len(us) < 2:
+            continue
+        reps: List[int] = []  # one member per cluster met in this bucket
+        for u in us:
+            ru = find(heads[u])
+            if any(find(heads[r]) == ru for r in reps):
+                continue  # already joined (in another band or via another member)
+            for r in reps:
+                if jaccard(sets[u], sets[r]) >= threshold:
+                    union(heads[r], heads[u])
+                    break
+            else:
+                if len(reps) < LSH_BUCKET_CHECKS:
+                    reps.append(u)
+
+    cluster = [find(i) for i in range(n)]
+    sizes: Dict[int, int] = {}
+    for c in cluster:
+        sizes[c] = sizes.get(c, 0) + 1
+    pairs = sum(c * (c - 1) // 2 for c in sizes.values())
+    return pairs, cluster
+
+
+@dataclass
+class ReviewFeatures:
+    """Everything the heuristics need from one review, computed once."""
+    norm: str
+    tokens: List[str]
+    shingles: Set[str]
+    has_neg: bool
+    has_pos: bool
+    day: Optional[int] = None  # date ordinal
+
+
+def review_features(r: Review) -> ReviewFeatures:
+    toks = tokenize(r.text)
+    tok_set = set(toks)
+    return ReviewFeatures(
+        norm=re.sub(r"\s+", " ", r.text.lower()).strip(),
+        tokens=toks,
+        shingles=shingles(toks, 3),
+        has_neg=not NEG_WORDS.isdisjoint(tok_set),
+        has_pos=not POS_WORDS.isdisjoint(tok_set),
+        day=r.created.toordinal() if r.created else None,
+    )
+
+
+def _trust_score(
+    reviews: List[Review], feats: List[ReviewFeatures], near_pairs: int
+) -> Tuple[int, List[str], Dict[str, float], Dict[str, int]]:
     reasons: List[str] = []
     penalties: Dict[str, int] = {}
     if not reviews:
         return 50, ["Нет отзывов с текстом — оценивать нечего."], {}, {"no_reviews": 0}
 
     n = len(reviews)
-    texts = [r.text for r in reviews]
-    tokens_list = [tokenize(t) for t in texts]
-    sh_list = [shingles(toks, 3) for toks in tokens_list]
 
     # exact duplicates
-    exact = Counter(re.sub(r"\s+", " ", t.lower()).strip() for t in texts)
+    exact = Counter(f.norm for f in feats)
     exact_dup_ratio = sum(1 for v in exact.values() if v >= 2) / max(1, len(exact))
 
-    # near duplicates (bounded sample)
-    near_pairs = 0
-    total_pairs = 0
-    max_n = min(n, 450)
-    for i in range(max_n):
-        for j in range(i + 1, max_n):
-            total_pairs += 1
-            if jaccard(sh_list[i], sh_list[j]) >= 0.8:
-                near_pairs += 1
+    # near duplicates (MinHash + LSH over every review)
+    total_pairs = n * (n - 1) // 2
     near_dup_ratio = near_pairs / max(1, total_pairs)
 
     dup_pen = int(min(40, 40 * (0.7 * near_dup_ratio + 0.3 * exact_dup_ratio)))
     penalties["duplicates"] = dup_pen
 
     # time spike
-    dates = [r.created.date() for r in reviews if r.created]
+    dates = [f.day for f in feats if f.day is not None]
     spike_share = 0.0
     if dates:
         c = Counter(dates)
@@ -157,22 +342,20 @@ def trust_score_details(reviews: List[Review]) -> Tuple[int, List[str], Dict[str
     # mismatch
     mismatch = 0
     rated = 0
-    for r in reviews:
+    for r, f in zip(reviews, feats):
         if r.rating is None:
             continue
         rated += 1
-        has_neg = _has_neg(r.text)
-        has_pos = _has_pos(r.text)
-        if r.rating >= 4 and has_neg:
+        if r.rating >= 4 and f.has_neg:
             mismatch += 1
-        elif r.rating <= 2 and has_pos:
+        elif r.rating <= 2 and f.has_pos:
             mismatch += 1
     mismatch_ratio = mismatch / max(1, rated)
     mismatch_pen = int(min(20, 20 * mismatch_ratio))
     penalties["mismatch"] = mismatch_pen
 
     # short
-    short = sum(1 for toks in tokens_list if len(toks) <= 3)
+    short = sum(1 for f in feats if len(f.tokens) <= 3)
     short_ratio = short / n
     short_pen = int(min(20, 20 * short_ratio))
     penalties["too_short"] = short_pen
@@ -197,40 +380,36 @@ def trust_score_details(reviews: List[Review]) -> Tuple[int, List[str], Dict[str
         "spike_share": float(spike_share),
         "mismatch_ratio": float(mismatch_ratio),
         "short_ratio": float(short_ratio),
-        "sampled_reviews_for_similarity": float(max_n),
+        "sampled_reviews_for_similarity": float(n),
         "rated_text_reviews": float(rated),
     }
     return score, reasons, signals, penalties
 
 
-def detect_suspicious_reviews(reviews: List[Review]) -> Tuple[Set[int], Dict[str, int]]:
-    """Indexes to drop + counts by reason.
-
-    This is a heuristic filter used ONLY to compute a 'clean rating' on text reviews.
-    """
+def _suspicious(
+    reviews: List[Review], feats: List[ReviewFeatures], cluster: List[int]
+) -> Tuple[Set[int], Dict[str, int]]:
     drop: Set[int] = set()
     counts = {"exact_duplicate": 0, "near_duplicate": 0, "too_short": 0, "mismatch": 0}
 
     # short / mismatch first
-    for i, r in enumerate(reviews):
-        toks = tokenize(r.text)
-        if len(toks) <= 3:
+    for i, (r, f) in enumerate(zip(reviews, feats)):
+        if len(f.tokens) <= 3:
             drop.add(i)
             counts["too_short"] += 1
             continue
         if r.rating is not None:
-            if r.rating >= 4 and _has_neg(r.text):
+            if r.rating >= 4 and f.has_neg:
                 drop.add(i)
                 counts["mismatch"] += 1
-            elif r.rating <= 2 and _has_pos(r.text):
+            elif r.rating <= 2 and f.has_pos:
                 drop.add(i)
                 counts["mismatch"] += 1
 
     # exact duplicates: keep first, drop rest
     norm_map: Dict[str, List[int]] = {}
-    for i, r in enumerate(reviews):
-        norm = re.sub(r"\s+", " ", r.text.lower()).strip()
-        norm_map.setdefault(norm, []).append(i)
+    for i, f in enumerate(feats):
+        norm_map.setdefault(f.norm, []).append(i)
     for idxs in norm_map.values():
         if len(idxs) >= 2:
             kept = None
@@ -244,33 +423,10 @@ def detect_suspicious_reviews(reviews: List[Review]) -> Tuple[Set[int], Dict[str
                         counts["exact_duplicate"] += 1
                     drop.add(i)
 
-    # near duplicates (bounded). cluster by similarity and keep one representative
-    n = len(reviews)
-    max_n = min(n, 450)
-    tokens_list = [tokenize(reviews[i].text) for i in range(max_n)]
-    sh_list = [shingles(toks, 3) for toks in tokens_list]
-
-    rep = list(range(max_n))
-
-    def find(x: int) -> int:
-        while rep[x] != x:
-            rep[x] = rep[rep[x]]
-            x = rep[x]
-        return x
-
-    def union(a: int, b: int) -> None:
-        ra, rb = find(a), find(b)
-        if ra != rb:
-            rep[rb] = ra
-
-    for i in range(max_n):
-        for j in range(i + 1, max_n):
-            if jaccard(sh_list[i], sh_list[j]) >= 0.8:
-                union(i, j)
-
+    # near duplicates (MinHash + LSH). cluster by similarity and keep one representative
     groups: Dict[int, List[int]] = {}
-    for i in range(max_n):
-        groups.setdefault(find(i), []).append(i)
+    for i, c in enumerate(cluster):
+        groups.setdefault(c, []).append(i)
 
     for g in groups.values():
         if len(g) < 3:
@@ -289,6 +445,23 @@ def detect_suspicious_reviews(reviews: List[Review]) -> Tuple[Set[int], Dict[str
     return drop, counts
 
 
+def trust_score_details(reviews: List[Review]) -> Tuple[int, List[str], Dict[str, float], Dict[str, int]]:
+    """Return: (score 0..100, reasons, signals, penalties_by_factor)."""
+    feats = [review_features(r) for r in reviews]
+    near_pairs, _ = near_duplicates([f.shingles for f in feats])
+    return _trust_score(reviews, feats, near_pairs)
+
+
+def detect_suspicious_reviews(reviews: List[Review]) -> Tuple[Set[int], Dict[str, int]]:
+    """Indexes to drop + counts by reason.
+
+    This is a heuristic filter used ONLY to compute a 'clean rating' on text reviews.
+    """
+    feats = [review_features(r) for r in reviews]
+    _, cluster = near_duplicates([f.shingles for f in feats])
+    return _suspicious(reviews, feats, cluster)
+
+
 def clean_rating(reviews: List[Review], drop_idx: Set[int]) -> Dict[str, Any]:
     kept = [r for i, r in enumerate(reviews) if i not in drop_idx and r.rating is not None]
     if not kept:
@@ -309,3 +482,29 @@ def summarize_stub(reviews: List[Review]) -> Dict[str, Any]:
         if len(age_hits) >= 3:
             break
     return {"age_failures": age_hits}
+
+
+def analyze_reviews(reviews: List[Review]) -> Dict[str, Any]:
+    """Single-pass pipeline: features and near-dup clusters are built once and
+    shared by the trust score and the suspicious-review filter."""
+    feats = [review_features(r) for r in reviews]
+    near_pairs, cluster = near_duplicates([f.shingles for f in feats])
+
+    score, reasons, signals, penalties = _trust_score(reviews, feats, near_pairs)
+    drop_idx, drop_counts = _suspicious(reviews, feats, cluster)
+
+    return {
+        "reviews_count": len(reviews),
+        "trust_score": score,
+        "reasons": reasons,
+        "signals": signals,
+        "penalties": penalties,
+        "clean_rating": clean_rating(reviews, drop_idx=drop_idx),
+        "drop_counts": drop_counts,
+        "summary": summarize_stub(reviews),
+    }
+
+
+def analyze_packed(packed: List[PackedReview]) -> Dict[str, Any]:
+    """Process-pool entry point (must stay a top-level function to be picklable)."""
+    return analyze_reviews(unpack_reviews(packed))
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional
+
+from .analyzer import PackedReview, Review, analyze_packed, analyze_reviews, pack_reviews
+
+
+class AnalyzerPool:
+    """Runs the pure analyzer stage off the event loop.
+
+    - workers <= 0 disables the pool (everything runs inline);
+    - inputs with <= inline_max_reviews reviews run inline: pickling costs more than the work;
+    - at most max_pending jobs are submitted at once, the rest wait for a slot;
+    - if a worker dies the executor is rebuilt and the affected call is retried
+      there once; if that kills a worker too, the call fails with BrokenProcessPool
+      (never inline: it may be the input that crashed it, e.g. by OOM).
+    """
+
+    def __init__(self, workers: int, max_pending: int = 32, inline_max_reviews: int = 200):
+        self.workers = workers
+        self.inline_max_reviews = inline_max_reviews
+        self._slots = asyncio.Semaphore(max(1, max_pending))
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self) -> None:
+        if self.workers > 0 and self._executor is None:
+            # spawn: never fork a process that already runs the loop and aiosqlite threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+    async def close(self) -> None:
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.to_thread(executor.shutdown, True, cancel_futures=True)
+
+    async def analyze(self, reviews: List[Review]) -> Dict[str, Any]:
+        if self._executor is None or len(reviews) <= self.inline_max_reviews:
+            return analyze_reviews(reviews)
+        packed = pack_reviews(reviews)
+        async with self._slots:
+            try:
+                return await self._run(packed)
+            except BrokenProcessPool:
+                return await self._run(packed)  # once more, on the rebuilt executor
+
+    async def _run(self, packed: List[PackedReview]) -> Dict[str, Any]:
+        executor = self._executor
+        if executor is None:
+            raise BrokenProcessPool("analyzer pool is closed")
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, analyze_packed, packed)
+        except BrokenProcessPool:
+            # a worker died (e.g. OOM): the executor is unusable from now on
+            self._restart(executor)
+            raise
+
+    def _restart(self, broken: ProcessPoolExecutor) -> None:
+        """Replace a broken executor once, however many calls saw it fail."""
+        if self._executor is not broken:
+            return
+        self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.start()
@@ -0,0 +1,97 @@
+"""Size / latency of cache value encodings: plain, zlib, zlib + trained dictionary.
+
+    python -m app.bench_cache [path/to/bot.sqlite3]
+
+Uses JSON rows from the cache table when a database is given (and has enough of
+them), otherwise synthetic card-like payloads.
+"""
+from __future__ import annotations
+
+import json
+import random
+import sqlite3
+import sys
+import time
+from typing import Dict, List
+
+from . import codec
+
+
+def _synthetic(n: int = 400) -> List[str]:
+    rnd = random.Random(1)
+    words = ["платье", "хлопок", "черный", "размер", "доставка", "качество", "ткань", "сезон", "женский"]
+    out = []
+    for _ in range(n):
+        nmid = rnd.randint(10_000_000, 300_000_000)
+        out.append(json.dumps({
+            "id": nmid,
+            "root": nmid // 3,
+            "kindId": 0,
+            "brand": rnd.choice(["Zara", "BeFree", "Gloria Jeans", "LIME"]),
+            "brandId": rnd.randint(1000, 90000),
+            "name": " ".join(rnd.sample(words, 4)),
+            "supplier": f"ИП {rnd.choice(['Иванов', 'Петров', 'Сидоров'])}",
+            "supplierId": rnd.randint(1, 500000),
+            "supplierRating": round(rnd.uniform(3.5, 5.0), 1),
+            "reviewRating": round(rnd.uniform(3.5, 5.0), 1),
+            "feedbacks": rnd.randint(0, 20000),
+            "colors": [{"name": rnd.choice(["черный", "белый", "бежевый"]), "id": rnd.randint(0, 16777215)}],
+            "sizes": [
+                {
+                    "name": s,
+                    "origName": s,
+                    "rank": rnd.randint(1, 99999),
+                    "optionId": rnd.randint(1, 10**9),
+                    "stocks": [{"wh": rnd.randint(100, 999999), "dtype": 4, "qty": rnd.randint(0, 300), "priority": 1}],
+                    "price": {"basic": rnd.randint(1000, 900000), "product": rnd.randint(1000, 900000), "total": rnd.randint(1000, 900000), "logistics": 0, "return": 0},
+                }
+                for s in ("XS", "S", "M", "L", "XL")[: rnd.randint(1, 5)]
+            ],
+        }, ensure_ascii=False))
+    return out
+
+
+def _from_db(path: str) -> List[str]:
+    con = sqlite3.connect(path)
+    try:
+        rows = con.execute("SELECT value_json FROM cache WHERE typeof(value_json)='text'").fetchall()
+    finally:
+        con.close()
+    return [r[0] for r in rows]
+
+
+def _run(name: str, values: List[str], version: int, zdict: bytes, zdicts: Dict[int, bytes]) -> None:
+    raw_total = sum(len(v.encode("utf-8")) for v in values)
+    t0 = time.perf_counter()
+    blobs = [codec.compress_value(v, version, zdict) for v in values] if name != "plain" else values
+    t1 = time.perf_counter()
+    if name != "plain":
+        for b in blobs:
+            codec.decompress_value(b, zdicts)
+    t2 = time.perf_counter()
+    size = sum(len(b) if isinstance(b, bytes) else len(b.encode("utf-8")) for b in blobs)
+    n = len(values)
+    print(
+        f"{name:<12} {size:>10} B  ratio {raw_total / size:5.2f}  "
+        f"compress {(t1 - t0) / n * 1e6:7.1f} us/value  decompress {(t2 - t1) / n * 1e6:7.1f} us/value"
+    )
+
+
+def main() -> None:
+    values = _from_db(sys.argv[1]) if len(sys.argv) > 1 else []
+    source = "db"
+    if len(values) < 20:
+        values, source = _synthetic(), "synthetic"
+    random.Random(2).shuffle(values)
+    # train on one half, measure on the other, as in production
+    half = len(values) // 2
+    train, test = values[:half], values[half:]
+    zdict = codec.train_zdict(train)
+    print(f"{source}: {len(test)} values, avg {sum(len(v) for v in test) // len(test)} chars, dict {len(zdict)} B")
+    _run("plain", test, 0, b"", {})
+    _run("zlib", test, 0, b"", {})
+    _run("zlib+dict", test, 1, zdict, {1: zdict})
+
+
+if __name__ == "__main__":
+    main()
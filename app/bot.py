@@ -1,23 +1,40 @@
 from __future__ import annotations
 
+import asyncio
+import html
+import time
 from datetime import datetime
-from typing import Any, Dict, Optional, Tuple, List
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple, List
 
-from aiogram import Dispatcher, F
+from aiogram import Bot, Dispatcher, F
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message
 
 from .analyzer import (
+    ANALYZER_VERSION,
+    MAX_REVIEWS,
     extract_reviews,
-    trust_score_details,
-    detect_suspicious_reviews,
-    clean_rating,
-    summarize_stub,
+    analyze_reviews,
+    encode_reviews,
+    decode_reviews,
+    reviews_digest,
 )
+from .analyzer_pool import AnalyzerPool
+from .codec import RawJSON
 from .config import Settings
+from .jobs import Job, JobHandler, JobQueue, QueueFull
+from .singleflight import SingleFlight
+from .swr import SWRCache
 from .storage import Storage
-from .wb_client import WBClient, extract_nmid
+from .wb_client import WBClient, extract_nmids
+
+
+# coalesces concurrent card/feedback fetches and analyses of the same product
+_flights = SingleFlight()
+# card/feedback reads: stale-while-revalidate + early refresh of hot keys
+_swr = SWRCache(_flights)
 
 
 def _fmt_money(value_u: Optional[int]) -> str:
@@ -41,71 +58,261 @@ def _fmt_ts(ts: int) -> str:
     return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M")
 
 
-async def analyze_one(nmid: int, settings: Settings, storage: Storage, wb: WBClient) -> Dict[str, Any]:
+def _card_key(nmid: int, settings: Settings) -> str:
+    # value: the card endpoint's response body (raw bytes when fetched one by one)
+    return f"card:v2:{nmid}:{settings.wb_dest}:{settings.wb_locale}"
+
+
+async def load_cards(
+    nmids: List[int], settings: Settings, storage: Storage, wb: WBClient, stale: Optional[Set[int]] = None
+) -> Dict[int, Dict[str, Any]]:
+    """Cards for many nmIds: cache hits first, the rest in bulk multi-nm requests.
+
+    Entries expired for at most `card_max_stale_seconds` are served as they are and
+    refreshed in one background bulk request, as for single cards; if `stale` is
+    given, it gets the nmIds served that way.
+    """
+    out: Dict[int, Dict[str, Any]] = {}
+    missing: List[int] = []
+    expired: List[int] = []
+    now = time.time()
+    for nmid in dict.fromkeys(nmids):
+        entry = await storage.cache_get_stale(_card_key(nmid, settings))
+        if entry is not None and entry[0] and now - entry[1] <= settings.card_max_stale_seconds:
+            out[nmid] = WBClient.first_product(entry[0])
+            if now > entry[1]:
+                expired.append(nmid)
+        else:
+            missing.append(nmid)
+    if expired:
+        if stale is not None:
+            stale.update(expired)
+        by_key = {_card_key(nmid, settings): nmid for nmid in expired}
+
+        async def refresh(keys: List[str]) -> Dict[str, Any]:
+            fetched = await _fetch_cards([by_key[k] for k in keys], settings, storage, wb)
+            # values as get_fresh() reads them from the cache: the card body
+            return {k: {"products": [fetched[by_key[k]]]} for k in keys if by_key[k] in fetched}
+
+        # shares the per-key refresh flight with single-card loads: one WB call per stale card
+        _swr.refresh_many(list(by_key), refresh)
+    if missing:
+        out.update(await _fetch_cards(missing, settings, storage, wb))
+    return out
+
+
+async def _fetch_cards(nmids: List[int], settings: Settings, storage: Storage, wb: WBClient) -> Dict[int, Dict[str, Any]]:
+    fetched = await wb.get_products(nmids)
+    await asyncio.gather(*(
+        # a multi-nm body holds many cards: each is serialized once, straight to bytes
+        storage.cache_set(
+            _card_key(nmid, settings), RawJSON.of({"products": [product]}), ttl_seconds=settings.card_ttl_seconds
+        )
+        for nmid, product in fetched.items()
+    ))
+    await asyncio.gather(*(
+        storage.root_set(nmid, int(product.get("root") or nmid)) for nmid, product in fetched.items()
+    ))
+    return fetched
+
+
+def _discard(task: "asyncio.Future[Any]") -> None:
+    """Cancel a speculative task we no longer need and silence its outcome."""
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+# revalidation metadata (card review count, endpoint validators) outlives the feedbacks
+FB_META_TTL_SECONDS = 30 * 24 * 3600
+
+
+async def analyze_root(
+    root_id: int,
+    settings: Settings,
+    storage: Storage,
+    wb: WBClient,
+    pool: Optional[AnalyzerPool] = None,
+    card: Optional[Awaitable[Tuple[Dict[str, Any], bool]]] = None,
+    card_key: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Feedbacks + analysis for one root (imt) id, coalesced across concurrent callers.
+
+    Feedbacks are read stale-while-revalidate. A refresh first revalidates the
+    old payload: if the card's review count matches the one saved with it, or
+    the endpoint answers 304 to its validators, only the TTL is extended.
+    `card` is (product, fresh) and may still be in flight; a card served stale
+    says nothing about the current review count, so the count is taken from its
+    background refresh (cache entry `card_key`) once that lands.
+    """
+    reviews_max = min(max(settings.reviews_max, settings.reviews_limit), MAX_REVIEWS)
+    # extracted reviews in compact binary form (see encode_reviews), not the raw WB JSON
+    fb_key = f"fbr:{root_id}:limit={settings.reviews_limit}:max={reviews_max}"
+    meta_key = f"{fb_key}:meta"
+
+    async def card_count() -> Optional[int]:
+        if card is None:
+            return None
+        try:
+            product, fresh = await card
+            if fresh:
+                return WBClient.feedback_count(product)
+            if card_key is None:
+                return None
+            await _swr.wait_refresh(card_key)
+            # not cache_get(): that would delete the stale entry if the refresh failed
+            entry = await storage.cache_get_stale(card_key)
+            if entry is None or entry[1] <= time.time():
+                return None  # the refresh failed: the count is still unknown
+            return WBClient.feedback_count(WBClient.first_product(entry[0]))
+        except Exception:
+            return None
+
+    async def unchanged(meta: Dict[str, Any]) -> bool:
+        count = await card_count()
+        if count is not None:
+            return meta.get("count") == count
+        return await wb.feedbacks_not_modified(root_id, settings.reviews_limit, meta)
+
+    async def refresh_feedbacks(previous: Optional[bytes]) -> bytes:
+        if previous is not None:
+            meta = await storage.cache_get(meta_key)
+            if meta and await unchanged(meta):
+                await storage.cache_touch(fb_key, settings.reviews_ttl_seconds)
+                return previous
+
+        meta = {}
+        feedback_json = await wb.get_feedbacks_paged(
+            root_id=root_id,
+            page_size=settings.reviews_limit,
+            max_items=reviews_max,
+            concurrency=settings.reviews_page_concurrency,
+            meta=meta,
+        )
+        meta["count"] = await card_count()
+        blob = encode_reviews(extract_reviews(feedback_json))
+        await storage.cache_set(fb_key, blob, ttl_seconds=settings.reviews_ttl_seconds)
+        await storage.cache_set(meta_key, meta, ttl_seconds=FB_META_TTL_SECONDS)
+        return blob
+
+    async def run_analysis() -> Dict[str, Any]:
+        blob = await _swr.get(
+            storage, fb_key, refresh_feedbacks, settings.swr_max_stale_seconds, settings.xfetch_beta
+        )
+        reviews = decode_reviews(blob)
+        digest = reviews_digest(reviews)
+        cached = await storage.analysis_get(root_id, digest, ANALYZER_VERSION)
+        if cached is not None:
+            return cached
+        analysis = await pool.analyze(reviews) if pool else analyze_reviews(reviews)
+        await storage.analysis_set(root_id, digest, ANALYZER_VERSION, analysis)
+        return analysis
+
+    return await _flights.do(f"analysis:{fb_key}", run_analysis)
+
+
+# progressive reply: the card-only stage is shown if the analysis takes longer than this
+CARD_STAGE_DELAY_S = 0.3
+
+
+async def analyze_one(
+    nmid: int,
+    settings: Settings,
+    storage: Storage,
+    wb: WBClient,
+    pool: Optional[AnalyzerPool] = None,
+    on_card: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+) -> Dict[str, Any]:
+    """Card, price history and review analysis for one nmId.
+
+    `on_card` gets the partial result (no analysis keys yet) once the card is in,
+    unless the analysis finishes within CARD_STAGE_DELAY_S anyway. A card served
+    stale records no price snapshot and marks the result's price "price_stale".
+    """
     # card
-    card_key = f"card:{nmid}:{settings.wb_dest}:{settings.wb_locale}"
-    product = await storage.cache_get(card_key)
-    if not product:
-        product = await wb.get_product(nmid)
-        await storage.cache_set(card_key, product, ttl_seconds=settings.card_ttl_seconds)
+    card_key = _card_key(nmid, settings)
 
-    root_id = int(product.get("root") or nmid)
+    async def refresh_card(_: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        raw = await wb.get_product_raw(nmid)
+        WBClient.first_product(await raw.parse())  # not found: raise instead of caching it
+        await storage.cache_set(card_key, raw, ttl_seconds=settings.card_ttl_seconds)
+        return raw.value
 
-    # price snapshot (we build history ourselves)
-    basic_u, product_u = WBClient.parse_price(product)
-    await storage.price_add_snapshot(nmid=nmid, basic_u=basic_u, product_u=product_u)
-    price_hist = await storage.price_get_history(nmid=nmid, limit=12)
+    async def load_card() -> Tuple[Dict[str, Any], bool]:
+        data, fresh = await _swr.get_fresh(
+            storage, card_key, refresh_card, settings.card_max_stale_seconds, settings.xfetch_beta
+        )
+        return WBClient.first_product(data), fresh
 
-    # feedbacks
-    fb_key = f"fb:{root_id}:limit={settings.reviews_limit}"
-    feedback_json = await storage.cache_get(fb_key)
-    if not feedback_json:
-        feedback_json = await wb.get_feedbacks(root_id=root_id, limit=settings.reviews_limit)
-        await storage.cache_set(fb_key, feedback_json, ttl_seconds=settings.reviews_ttl_seconds)
-
-    reviews = extract_reviews(feedback_json)
-
-    score, reasons, signals, penalties = trust_score_details(reviews)
-
-    drop_idx, drop_counts = detect_suspicious_reviews(reviews)
-    clean = clean_rating(reviews, drop_idx=drop_idx)
-
-    summ = summarize_stub(reviews)
-
-    return {
-        "nmid": nmid,
-        "root_id": root_id,
-        "product": product,
-        "reviews_count": len(reviews),
-        "trust_score": score,
-        "reasons": reasons,
-        "signals": signals,
-        "penalties": penalties,
-        "clean_rating": clean,
-        "drop_counts": drop_counts,
-        "summary": summ,
-        "price": {"basic_u": basic_u, "product_u": product_u},
-        "price_history": price_hist,
-    }
+    card = asyncio.ensure_future(load_card())
 
+    # a known nmId -> root mapping lets feedbacks load while the card is in flight
+    known_root = await storage.root_get(nmid)
+    early = (
+        asyncio.ensure_future(analyze_root(known_root, settings, storage, wb, pool, card, card_key))
+        if known_root
+        else None
+    )
 
-def build_message(result: Dict[str, Any], original_url: Optional[str] = None) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    try:
+        product, card_fresh = await card
+    except BaseException:
+        if early:
+            _discard(early)
+        raise
+
+    root_id = int(product.get("root") or nmid)
+    if root_id != known_root:
+        # first sight of this nmId, or WB moved it to another root
+        if early:
+            _discard(early)
+            early = None
+        await storage.root_set(nmid, root_id)
+
+    # feedbacks
+    analysis_task = early or asyncio.ensure_future(analyze_root(root_id, settings, storage, wb, pool, card, card_key))
+
+    try:
+        # price snapshot (we build history ourselves); a stale card's price is not "now"
+        basic_u, product_u = WBClient.parse_price(product)
+        if card_fresh:
+            await storage.price_add_snapshot(nmid=nmid, basic_u=basic_u, product_u=product_u)
+        price_hist = await storage.price_get_history(nmid=nmid, limit=12)
+        result = {
+            "nmid": nmid,
+            "root_id": root_id,
+            "product": product,
+            "price": {"basic_u": basic_u, "product_u": product_u},
+            "price_stale": not card_fresh,
+            "price_history": price_hist,
+        }
+
+        if on_card is not None:
+            await asyncio.wait({analysis_task}, timeout=CARD_STAGE_DELAY_S)
+            if not analysis_task.done():
+                try:
+                    await on_card(result)
+                except Exception:
+                    pass  # the progress stage is best effort
+    except BaseException:
+        _discard(analysis_task)
+        raise
+
+    return {**result, **await analysis_task}
+
+
+def _card_lines(result: Dict[str, Any]) -> List[str]:
+    """Card part of the reply: needs only the card and price keys of the result."""
     product = result["product"]
     nmid = result["nmid"]
-    name = product.get("name") or "Товар"
-    brand = product.get("brand") or ""
+    name = html.escape(product.get("name") or "Товар")
+    brand = html.escape(product.get("brand") or "")
     rating_raw = product.get("rating") or product.get("reviewRating")
     try:
         rating = f"{float(rating_raw):.1f}"
     except Exception:
-        rating = str(rating_raw) if rating_raw is not None else "—"
+        rating = html.escape(str(rating_raw)) if rating_raw is not None else "—"
 
-    fb_cnt = product.get("feedbacks") or product.get("nmFeedbacks") or "—"
-
-    score = int(result["trust_score"])
-    tl = _traffic_light(score)
-    penalties = result.get("penalties") or {}
-    signals = result.get("signals") or {}
+    fb_cnt = html.escape(str(product.get("feedbacks") or product.get("nmFeedbacks") or "—"))
 
     basic_u = (result.get("price") or {}).get("basic_u")
     product_u = (result.get("price") or {}).get("product_u")
@@ -115,14 +322,18 @@ def build_message(result: Dict[str, Any], original_url: Optional[str] = None) ->
     if brand:
         lines.append(f"Бренд: <b>{brand}</b>")
     lines.append(f"Артикул (nmId): <code>{nmid}</code>")
-    lines.append(f"Рейтинг WB: <b>{rating}</b> • отзывов: <b>{fb_cnt}</b> • текстовых взято: <b>{result['reviews_count']}</b>")
+    if "reviews_count" in result:
+        lines.append(f"Рейтинг WB: <b>{rating}</b> • отзывов: <b>{fb_cnt}</b> • текстовых взято: <b>{result['reviews_count']}</b>")
+    else:
+        lines.append(f"Рейтинг WB: <b>{rating}</b> • отзывов: <b>{fb_cnt}</b>")
 
     # show price numbers but not "discount verdict"
     if product_u is not None:
+        label = "Цена (WB, может быть устаревшей)" if result.get("price_stale") else "Цена сейчас (WB)"
         if basic_u is not None and basic_u != product_u:
-            lines.append(f"Цена сейчас (WB): <b>{_fmt_money(product_u)}</b> • basic: {_fmt_money(basic_u)}")
+            lines.append(f"{label}: <b>{_fmt_money(product_u)}</b> • basic: {_fmt_money(basic_u)}")
         else:
-            lines.append(f"Цена сейчас (WB): <b>{_fmt_money(product_u)}</b>")
+            lines.append(f"{label}: <b>{_fmt_money(product_u)}</b>")
 
     # history we collected
     hist = result.get("price_history") or []
@@ -140,6 +351,115 @@ def build_message(result: Dict[str, Any], original_url: Optional[str] = None) ->
             else:
                 lines.append(f"• {ts}: {_fmt_money(pu)}")
 
+    return lines
+
+
+def _keyboard(original_url: Optional[str]) -> Optional[InlineKeyboardMarkup]:
+    if original_url and "wildberries.ru" in original_url:
+        return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Открыть товар на WB", url=original_url)]])
+    return None
+
+
+def build_card_message(result: Dict[str, Any], original_url: Optional[str] = None) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """First stage of a progressive reply: the card while the reviews are analyzed."""
+    lines = _card_lines(result)
+    lines.append("")
+    lines.append("⏳ Анализирую отзывы, Trust Score будет здесь через пару секунд…")
+    return "\n".join(lines), _keyboard(original_url)
+
+
+async def analyze_many(
+    nmids: List[int], settings: Settings, storage: Storage, wb: WBClient, pool: Optional[AnalyzerPool] = None
+) -> List[Dict[str, Any]]:
+    """Several nmIds at once: cards in bulk, then feedbacks + analysis per distinct
+    root, at most `multi_concurrency` at a time. One entry per nmId in input order;
+    failed ones carry an "error" key instead of analysis keys."""
+    stale: Set[int] = set()
+    cards = await load_cards(nmids, settings, storage, wb, stale)
+    # price history is recorded for every fresh card; unchanged prices cost no SQL
+    await storage.price_add_snapshots(
+        [(nmid, *WBClient.parse_price(p)) for nmid, p in cards.items() if nmid not in stale]
+    )
+
+    slots = asyncio.Semaphore(max(1, settings.multi_concurrency))
+    loop = asyncio.get_running_loop()
+
+    async def analyze(root_id: int, nmid: int, product: Dict[str, Any]) -> Dict[str, Any]:
+        card: "asyncio.Future[Tuple[Dict[str, Any], bool]]" = loop.create_future()
+        card.set_result((product, nmid not in stale))
+        async with slots:
+            return await analyze_root(root_id, settings, storage, wb, pool, card, _card_key(nmid, settings))
+
+    roots: Dict[int, "asyncio.Future[Dict[str, Any]]"] = {}
+    for nmid, product in cards.items():
+        root_id = int(product.get("root") or nmid)
+        if root_id not in roots:
+            roots[root_id] = asyncio.ensure_future(analyze(root_id, nmid, product))
+    if roots:
+        await asyncio.wait(roots.values())
+
+    out: List[Dict[str, Any]] = []
+    for nmid in dict.fromkeys(nmids):
+        product = cards.get(nmid)
+        if product is None:
+            out.append({"nmid": nmid, "error": "не найден на WB"})
+            continue
+        root_id = int(product.get("root") or nmid)
+        task = roots[root_id]
+        basic_u, product_u = WBClient.parse_price(product)
+        entry: Dict[str, Any] = {
+            "nmid": nmid,
+            "root_id": root_id,
+            "product": product,
+            "price": {"basic_u": basic_u, "product_u": product_u},
+            "price_stale": nmid in stale,
+        }
+        if task.exception() is not None:
+            entry["error"] = str(task.exception()) or type(task.exception()).__name__
+        else:
+            entry.update(task.result())
+        out.append(entry)
+    return out
+
+
+def build_compare_message(results: List[Dict[str, Any]]) -> str:
+    """Compact comparison of several products, best Trust Score first."""
+    ok = sorted((r for r in results if "trust_score" in r), key=lambda r: -int(r["trust_score"]))
+    failed = [r for r in results if "trust_score" not in r]
+
+    lines: List[str] = [f"<b>Сравнение товаров ({len(results)})</b> — по Trust Score:", ""]
+    for i, r in enumerate(ok, 1):
+        product = r["product"]
+        score = int(r["trust_score"])
+        name = html.escape((product.get("name") or "Товар")[:40])
+        clean = (r.get("clean_rating") or {}).get("avg")
+        price_u = (r.get("price") or {}).get("product_u")
+        price = ("≈" if r.get("price_stale") else "") + _fmt_money(price_u)
+        lines.append(f"{i}. {_traffic_light(score)} <b>{score}</b> • {name}")
+        lines.append(
+            f"    <code>{r['nmid']}</code> • {price} • "
+            f"чистый рейтинг: {clean if clean is not None else '—'} • отзывов взято: {r.get('reviews_count', 0)}"
+        )
+    if any(r.get("price_stale") for r in ok):
+        lines.append("≈ — цена из кэша, могла измениться.")
+    if failed:
+        lines.append("")
+        lines.append("<b>Не получилось:</b>")
+        for r in failed:
+            lines.append(f"• <code>{r['nmid']}</code>: {html.escape(str(r.get('error') or '—'))}")
+    lines.append("")
+    lines.append("Подробный разбор — пришли один артикул отдельным сообщением.")
+    return "\n".join(lines)
+
+
+def build_message(result: Dict[str, Any], original_url: Optional[str] = None) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    lines = _card_lines(result)
+
+    score = int(result["trust_score"])
+    tl = _traffic_light(score)
+    penalties = result.get("penalties") or {}
+    signals = result.get("signals") or {}
+
     # trust score + breakdown
     lines.append("")
     lines.append(f"{tl} <b>Trust Score:</b> <b>{score}/100</b>")
@@ -174,15 +494,93 @@ def build_message(result: Dict[str, Any], original_url: Optional[str] = None) ->
         lines.append("")
         lines.append("<b>Жалобы по сроку службы:</b>")
         for x in summ["age_failures"]:
-            lines.append(f"• {x}")
+            lines.append(f"• {html.escape(x)}")
+
+    return "\n".join(lines), _keyboard(original_url)
+
+
+# last resort when the answer itself cannot be shown (sent without parse mode)
+FAILED_TEXT = "Не получилось показать результат 😕 Попробуй ещё раз чуть позже."
+
+
+def make_job_handler(
+    bot: Bot, settings: Settings, storage: Storage, wb: WBClient, pool: Optional[AnalyzerPool] = None
+) -> JobHandler:
+    """Runs one queued analysis request. The answer replaces the job's placeholder
+    message in stages: card first, then the full analysis. If showing it fails,
+    the placeholder gets a plain-text FAILED_TEXT and the error propagates."""
+
+    async def run(job: Job) -> None:
+        text = job.payload.get("text") or ""
+        reply_id: Optional[int] = job.payload.get("reply_id")
+
+        async def show(msg: str, kb: Optional[InlineKeyboardMarkup] = None) -> None:
+            nonlocal reply_id
+            if reply_id is not None:
+                try:
+                    await bot.edit_message_text(
+                        msg, chat_id=job.chat_id, message_id=reply_id, parse_mode=ParseMode.HTML, reply_markup=kb
+                    )
+                    return
+                except TelegramBadRequest as e:
+                    if "not modified" in str(e):
+                        return
+                    reply_id = None  # placeholder is gone: fall back to a new message
+            sent = await bot.send_message(job.chat_id, msg, parse_mode=ParseMode.HTML, reply_markup=kb)
+            reply_id = sent.message_id
+
+        async def on_card(partial: Dict[str, Any]) -> None:
+            await show(*build_card_message(partial, original_url=text))
+
+        async def answer() -> None:
+            if "nmids" in job.payload:
+                try:
+                    results = await analyze_many([int(x) for x in job.payload["nmids"]], settings, storage, wb, pool)
+                except Exception as e:
+                    await show(f"Не получилось получить данные WB: {html.escape(str(e))}")
+                    return
+                await show(build_compare_message(results))
+                return
+
+            try:
+                res = await analyze_one(
+                    nmid=int(job.payload["nmid"]), settings=settings, storage=storage, wb=wb, pool=pool, on_card=on_card
+                )
+            except Exception as e:
+                await show(f"Не получилось получить данные WB: {html.escape(str(e))}")
+                return
+
+            await show(*build_message(res, original_url=text))
 
-    kb = None
-    if original_url and "wildberries.ru" in original_url:
-        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Открыть товар на WB", url=original_url)]])
-    return "\n".join(lines), kb
+        try:
+            await answer()
+        except Exception:
+            if reply_id is not None:
+                try:
+                    await bot.edit_message_text(FAILED_TEXT, chat_id=job.chat_id, message_id=reply_id, parse_mode=None)
+                except Exception:
+                    pass  # placeholder gone or Telegram unreachable: the queue logs the original error
+            raise
+
+    return run
 
 
-def setup_handlers(dp: Dispatcher, settings: Settings, storage: Storage, wb: WBClient) -> None:
+def make_replaced_handler(bot: Bot) -> JobHandler:
+    """Marks the placeholder of a queued job that a newer request replaced."""
+
+    async def replaced(job: Job) -> None:
+        reply_id = job.payload.get("reply_id")
+        if reply_id is None:
+            return
+        try:
+            await bot.edit_message_text("Заменён новым запросом ⤵️", chat_id=job.chat_id, message_id=reply_id)
+        except TelegramBadRequest:
+            pass  # placeholder already gone
+
+    return replaced
+
+
+def setup_handlers(dp: Dispatcher, settings: Settings, storage: Storage, jobs: JobQueue) -> None:
     @dp.message(CommandStart())
     async def start(m: Message) -> None:
         txt = (
@@ -205,18 +603,24 @@ def setup_handlers(dp: Dispatcher, settings: Settings, storage: Storage, wb: WBC
             return
 
         text = (m.text or "").strip()
-        nmid = extract_nmid(text)
-        if not nmid:
+        nmids = extract_nmids(text, limit=settings.multi_max_products)
+        if not nmids:
             await m.answer("Не вижу артикул WB. Пришли ссылку на товар или nmId цифрами.")
             return
+        # several products in one message are one job (and one rate-limit slot)
+        payload: Dict[str, Any] = {"text": text, "nmid": nmids[0]} if len(nmids) == 1 else {"text": text, "nmids": nmids}
 
-        await m.answer("Секунду… анализирую отзывы и обновляю историю цены 👀")
-
-        try:
-            res = await analyze_one(nmid=nmid, settings=settings, storage=storage, wb=wb)
-        except Exception as e:
-            await m.answer(f"Не получилось получить данные WB: {e}")
+        # the analysis itself runs in the job queue, never inside the update handler;
+        # its answer is edited into this placeholder
+        if jobs.full_for(user_id):
+            await m.answer("Сейчас очень много запросов 😮‍💨 Попробуй через пару минут.")
             return
-
-        msg, kb = build_message(res, original_url=text)
-        await m.answer(msg, parse_mode=ParseMode.HTML, reply_markup=kb)
+        position = jobs.next_position(user_id)
+        if position:
+            placeholder = await m.answer(f"Принял! Ты в очереди: {position}. Результат появится здесь ⏳")
+        else:
+            placeholder = await m.answer("Секунду… анализирую отзывы и обновляю историю цены 👀")
+        try:
+            await jobs.submit(user_id, m.chat.id, {**payload, "reply_id": placeholder.message_id})
+        except QueueFull:
+            await placeholder.edit_text("Сейчас очень много запросов 😮‍💨 Попробуй через пару минут.")
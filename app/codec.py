@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import re
+import struct
+import zlib
+from collections import Counter
+from typing import Any, Dict, Iterable, Union
+
+# compressed cache value:  MAGIC | kind | u16 dict version (0 = none) | zlib stream
+#   kind: b"J" JSON text, b"B" opaque bytes, b"R" JSON as UTF-8 bytes (RawJSON; also
+#   framed below the compression threshold, as a level-0 stream, so it stays bytes)
+# Anything without the magic is a legacy plain value (JSON text or an uncompressed BLOB).
+MAGIC = b"\x00ZC"
+_HEADER = struct.Struct("<3scH")
+
+ZDICT_MAX_BYTES = 32 * 1024  # zlib only looks back 32 KiB anyway
+
+# JSON bigger than this is parsed in a worker thread
+PARSE_IN_THREAD_BYTES = 256 * 1024
+
+# JSON keys with their colon, and short runs between structural characters
+_KEY_RE = re.compile(r'"[^"\\]{1,48}":')
+_RUN_RE = re.compile(r'[^{}\[\],]{4,64}')
+
+
+def train_zdict(samples: Iterable[str], max_bytes: int = ZDICT_MAX_BYTES, min_df: int = 2) -> bytes:
+    """Preset dictionary from sample JSON payloads.
+
+    Fragments (keys, short value runs) are scored by document frequency x length;
+    the best ones go last, since zlib finds nearer matches with shorter codes.
+    """
+    df: Counter[str] = Counter()
+    n = 0
+    for text in samples:
+        n += 1
+        frags = set(_KEY_RE.findall(text))
+        frags.update(_RUN_RE.findall(text))
+        df.update(frags)
+    if not n:
+        return b""
+
+    picked = []
+    total = 0
+    for frag, cnt in sorted(df.items(), key=lambda kv: kv[1] * len(kv[0]), reverse=True):
+        if cnt < min(min_df, n):
+            continue
+        b = frag.encode("utf-8")
+        if total + len(b) > max_bytes:
+            continue
+        picked.append(b)
+        total += len(b)
+    return b"".join(reversed(picked))
+
+
+def is_compressed(blob: Union[str, bytes]) -> bool:
+    return isinstance(blob, bytes) and blob[:3] == MAGIC
+
+
+def compress_value(
+    raw: Union[str, bytes, "RawJSON"], version: int = 0, zdict: bytes = b"", level: int = 6
+) -> bytes:
+    if isinstance(raw, RawJSON):
+        kind, data = b"R", raw.raw
+    elif isinstance(raw, bytes):
+        kind, data = b"B", raw
+    else:
+        kind, data = b"J", raw.encode("utf-8")
+    c = zlib.compressobj(level, zdict=zdict) if zdict else zlib.compressobj(level)
+    return _HEADER.pack(MAGIC, kind, version if zdict else 0) + c.compress(data) + c.flush()
+
+
+def decompress_value(blob: bytes, zdicts: Dict[int, bytes]) -> Union[str, bytes, "RawJSON"]:
+    """Inverse of compress_value; raises ValueError on anything it cannot restore."""
+    _, kind, version = _HEADER.unpack_from(blob)
+    if version:
+        zdict = zdicts.get(version)
+        if zdict is None:
+            raise ValueError(f"unknown compression dictionary v{version}")
+        d = zlib.decompressobj(zdict=zdict)
+    else:
+        d = zlib.decompressobj()
+    try:
+        data = d.decompress(blob[_HEADER.size:]) + d.flush()
+    except zlib.error as e:
+        raise ValueError(str(e)) from e
+    if kind == b"R":
+        return RawJSON(data)
+    return data if kind == b"B" else data.decode("utf-8")
+
+
+class RawJSON:
+    """JSON document kept as the bytes it arrived in (e.g. an HTTP body).
+
+    Storage writes the bytes as is instead of re-serializing; the parsed object
+    is built on first use and memoized, in a thread for large documents.
+    Treat `value` as read-only: it is shared like any other cached value.
+    """
+
+    __slots__ = ("raw", "_value", "_parsed")
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self._value: Any = None
+        self._parsed = False
+
+    @classmethod
+    def of(cls, value: Any) -> "RawJSON":
+        """Serialize `value` once, straight to bytes, keeping it as the parsed form."""
+        doc = cls(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        doc._value, doc._parsed = value, True
+        return doc
+
+    def __len__(self) -> int:
+        return len(self.raw)
+
+    @property
+    def value(self) -> Any:
+        if not self._parsed:
+            self._value = json.loads(self.raw)
+            self._parsed = True
+        return self._value
+
+    async def parse(self) -> Any:
+        if not self._parsed and len(self.raw) >= PARSE_IN_THREAD_BYTES:
+            self._value = await asyncio.to_thread(json.loads, self.raw)
+            self._parsed = True
+        return self.value
+
+    def text(self) -> str:
+        return self.raw.decode("utf-8")
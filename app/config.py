@@ -13,6 +13,13 @@ def _get_int(name: str, default: int) -> int:
     except ValueError:
         return default
 
+def _get_float(name: str, default: float) -> float:
+    v = os.getenv(name, str(default)).strip()
+    try:
+        return float(v)
+    except ValueError:
+        return default
+
 @dataclass(frozen=True)
 class Settings:
     bot_token: str
@@ -20,12 +27,64 @@ class Settings:
     wb_locale: str = os.getenv("WB_LOCALE", "ru").strip()
     wb_dest: str = os.getenv("WB_DEST", "-1216601,-115136,-421732,123585595").strip()
 
-    reviews_limit: int = _get_int("REVIEWS_LIMIT", 120)
+    reviews_limit: int = _get_int("REVIEWS_LIMIT", 120)  # page size
+    # paginated feedback fetch: total cap and pages in flight; by default everything the
+    # analyzer reads (analyzer.MAX_REVIEWS, also the upper bound of this setting)
+    reviews_max: int = _get_int("REVIEWS_MAX", 4000)
+    reviews_page_concurrency: int = _get_int("REVIEWS_PAGE_CONCURRENCY", 4)
+    # delay before a hedged request to the next feedback host/variant (~p95 latency)
+    feedback_hedge_delay_ms: int = _get_int("FEEDBACK_HEDGE_DELAY_MS", 1500)
     card_ttl_seconds: int = _get_int("CARD_TTL_SECONDS", 600)
     reviews_ttl_seconds: int = _get_int("REVIEWS_TTL_SECONDS", 3600)
 
+    # card/feedback caches: serve expired entries this long while one background
+    # refresh runs (0 = off); XFetch beta for early refresh of hot keys (0 = off)
+    swr_max_stale_seconds: int = _get_int("SWR_MAX_STALE_SECONDS", 6 * 3600)
+    # cards carry the current price: a much shorter stale window for them
+    card_max_stale_seconds: int = _get_int("CARD_MAX_STALE_SECONDS", 300)
+    xfetch_beta: float = _get_float("XFETCH_BETA", 1.0)
+
+    # in-process LRU in front of the sqlite cache table
+    mem_cache_max_bytes: int = _get_int("MEM_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+
+    # sqlite cache table: sweeper period and size cap (LRU eviction; 0 = unbounded)
+    cache_sweep_seconds: int = _get_int("CACHE_SWEEP_SECONDS", 300)
+    cache_max_bytes: int = _get_int("CACHE_MAX_BYTES", 512 * 1024 * 1024)
+    # analysis results and the nmId -> root map: rows not written for this long are swept (0 = kept)
+    derived_max_age_seconds: int = _get_int("DERIVED_MAX_AGE_SECONDS", 30 * 24 * 3600)
+
     rate_limit_window_seconds: int = _get_int("RATE_LIMIT_WINDOW_SECONDS", 60)
     rate_limit_max_requests: int = _get_int("RATE_LIMIT_MAX_REQUESTS", 6)
+    rate_limit_snapshot_seconds: int = _get_int("RATE_LIMIT_SNAPSHOT_SECONDS", 30)
+
+    # webhook mode when WEBHOOK_URL (public base URL) is set, long polling otherwise;
+    # the secret defaults to one derived from the bot token; web_workers > 1 preforks
+    webhook_url: str = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+    webhook_path: str = os.getenv("WEBHOOK_PATH", "/webhook").strip()
+    webhook_secret: str = os.getenv("WEBHOOK_SECRET", "").strip()
+    web_host: str = os.getenv("WEB_HOST", "0.0.0.0").strip()
+    web_port: int = _get_int("WEB_PORT", 8080)
+    web_workers: int = _get_int("WEB_WORKERS", 1)
+
+    # outbound Bot API pacing: global calls/s (split across prefork workers) and per-chat gap
+    tg_send_per_second: float = _get_float("TG_SEND_PER_SECOND", 30.0)
+    tg_chat_interval_ms: int = _get_int("TG_CHAT_INTERVAL_MS", 1000)
+
+    # several products in one message: how many are taken, roots analyzed at once
+    multi_max_products: int = _get_int("MULTI_MAX_PRODUCTS", 10)
+    multi_concurrency: int = _get_int("MULTI_CONCURRENCY", 4)
+
+    # analysis job queue: concurrent jobs (one per user at a time), backlog bound
+    job_workers: int = _get_int("JOB_WORKERS", 4)
+    job_max_queued: int = _get_int("JOB_MAX_QUEUED", 500)
+
+    # analyzer process pool (0 workers = run inline on the event loop)
+    analyzer_workers: int = _get_int("ANALYZER_WORKERS", 2)
+    analyzer_max_pending: int = _get_int("ANALYZER_MAX_PENDING", 32)
+    analyzer_inline_max_reviews: int = _get_int("ANALYZER_INLINE_MAX_REVIEWS", 200)
+
+    # zlib (+ trained preset dictionary) for cache values of at least this size; 0 = off
+    cache_compress_min_bytes: int = _get_int("CACHE_COMPRESS_MIN_BYTES", 512)
 
     sqlite_path: str = os.getenv("SQLITE_PATH", "/data/bot.sqlite3").strip()
 
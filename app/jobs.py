@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from .storage import Storage
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class Job:
+    id: int
+    user_id: int
+    chat_id: int
+    payload: Dict[str, Any] = field(default_factory=dict)
+    attempts: int = 0
+    not_before: float = 0.0  # loop time; set while the user's job runs in another process
+
+
+JobHandler = Callable[[Job], Awaitable[None]]
+
+
+class QueueFull(Exception):
+    pass
+
+
+# shared database: how soon a job blocked by its user's job in another process is retried
+BUSY_RETRY_SECONDS = 0.5
+# a job whose start failed in Storage (e.g. the database was locked) is retried after this long
+START_RETRY_SECONDS = 2.0
+
+
+class JobQueue:
+    """Analysis requests run by a fixed number of async workers.
+
+    - at most one job per user is in flight; a new request replaces the user's
+      queued (not yet started) job, which is then passed to `on_replaced`;
+    - jobs are persisted in Storage: queued and interrupted ones run again after
+      a restart, up to `max_attempts` starts each;
+    - `max_queued` bounds the backlog: submit() raises QueueFull beyond it.
+
+    When several processes share the database (Storage.shared), the per-user
+    rules are enforced in SQL: a job starts only through Storage.job_claim(), and
+    submit() drops the user's queued jobs whichever process holds them.
+    Interrupted jobs must then be requeued before any process starts
+    (Storage.job_requeue_interrupted()) and after one dies (the prefork
+    supervisor, main._requeue_jobs_of()); recovery there takes only
+    queued rows, as other processes may be running theirs.
+    """
+
+    def __init__(self, storage: Storage, workers: int = 4, max_queued: int = 500, max_attempts: int = 3):
+        self.storage = storage
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+        self._queued: "OrderedDict[int, Job]" = OrderedDict()
+        self._by_user: Dict[int, int] = {}
+        self._running: Set[int] = set()
+        self._cond = asyncio.Condition()
+        self._tasks: List[asyncio.Task[None]] = []
+        self._handler: Optional[JobHandler] = None
+        self._on_replaced: Optional[JobHandler] = None
+
+    @property
+    def idle_workers(self) -> int:
+        return self.workers - len(self._running)
+
+    def __len__(self) -> int:
+        return len(self._queued)
+
+    async def start(
+        self, handler: JobHandler, recover: bool = True, on_replaced: Optional[JobHandler] = None
+    ) -> None:
+        """Start the workers; with `recover`, persisted jobs are queued again first
+        (in a shared database a job also queued by another process still runs once).
+        `on_replaced` runs in the background for each job dropped for a newer one."""
+        self._handler = handler
+        self._on_replaced = on_replaced
+        persisted = await self.storage.job_list(queued_only=self.storage.shared) if recover else []
+        for job_id, user_id, chat_id, payload, attempts in persisted:
+            if attempts >= self.max_attempts:
+                await self.storage.job_done(job_id)  # keeps failing (or crashing us): give up
+                continue
+            old = self._by_user.get(user_id)
+            if old is not None:
+                self._notify_replaced(self._queued.pop(old))
+                await self.storage.job_done(old)
+            self._queued[job_id] = Job(job_id, user_id, chat_id, payload, attempts)
+            self._by_user[user_id] = job_id
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self) -> None:
+        """Stop the workers; unfinished jobs stay persisted for the next start."""
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def full_for(self, user_id: int) -> bool:
+        """Would submit() for this user raise QueueFull right now."""
+        return user_id not in self._by_user and len(self._queued) >= self.max_queued
+
+    def next_position(self, user_id: int) -> int:
+        """Queue position a job submitted now by this user would get; 0 if it would start right away."""
+        position = len(self._queued) - (1 if user_id in self._by_user else 0) + 1
+        if user_id not in self._running and position <= self.idle_workers:
+            return 0
+        return position
+
+    async def submit(self, user_id: int, chat_id: int, payload: Dict[str, Any]) -> int:
+        """Queue a job; returns its 1-based position among queued jobs."""
+        if self.full_for(user_id):
+            raise QueueFull()
+        job_id = await self.storage.job_put(user_id, chat_id, payload)
+        replaced = self._by_user.get(user_id)  # checked after persisting: a worker may have taken it
+        if self.storage.shared:
+            # also in other processes; a job taken but not yet claimed here is dropped too
+            for old_id, old_chat_id, old_payload in await self.storage.job_drop_queued(user_id, keep=job_id):
+                self._queued.pop(old_id, None)
+                self._notify_replaced(Job(old_id, user_id, old_chat_id, old_payload))
+        elif replaced is not None:
+            self._notify_replaced(self._queued.pop(replaced, None))
+            await self.storage.job_done(replaced)
+        self._queued[job_id] = Job(job_id, user_id, chat_id, payload)
+        self._by_user[user_id] = job_id
+        async with self._cond:
+            self._cond.notify()
+        return self.position(job_id)
+
+    def position(self, job_id: int) -> int:
+        for i, queued_id in enumerate(self._queued, 1):
+            if queued_id == job_id:
+                return i
+        return 0
+
+    def _notify_replaced(self, job: Optional[Job]) -> None:
+        if job is not None and self._on_replaced is not None:
+            task = asyncio.ensure_future(self._on_replaced(job))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def _take(self) -> Optional[Job]:
+        now = asyncio.get_running_loop().time()
+        for job in self._queued.values():
+            if job.user_id not in self._running and job.not_before <= now:
+                del self._queued[job.id]
+                if self._by_user.get(job.user_id) == job.id:
+                    del self._by_user[job.user_id]
+                self._running.add(job.user_id)
+                return job
+        return None
+
+    def _wakeup_in(self) -> Optional[float]:
+        """Seconds until the earliest deferred job may run; None if nothing is deferred."""
+        deferred = [
+            job.not_before for job in self._queued.values() if job.not_before and job.user_id not in self._running
+        ]
+        if not deferred:
+            return None
+        return max(0.0, min(deferred) - asyncio.get_running_loop().time())
+
+    async def _claim(self, job: Job) -> bool:
+        """Start `job` in the shared database; otherwise put it back (its user's job
+        runs elsewhere) or forget it (replaced elsewhere)."""
+        claimed = await self.storage.job_claim(job.id, job.user_id)
+        if claimed is False:
+            await self._put_back(job, BUSY_RETRY_SECONDS)
+        return bool(claimed)
+
+    async def _start(self, job: Job) -> bool:
+        """Mark `job` running in Storage; False if it must not run (yet)."""
+        if self.storage.shared:
+            return await self._claim(job)
+        await self.storage.job_start(job.id)
+        return True
+
+    async def _put_back(self, job: Job, delay: float) -> None:
+        """Queue a taken but not started job again, due in `delay` seconds, unless a
+        newer job of its user was queued here meanwhile: that one replaces it."""
+        if job.user_id in self._by_user:
+            if not self.storage.shared:  # shared: submit() has dropped its row and notified
+                self._notify_replaced(job)
+                await self.storage.job_done(job.id)
+            return
+        job.not_before = asyncio.get_running_loop().time() + delay
+        self._queued[job.id] = job
+        self._by_user[job.user_id] = job.id
+
+    async def _worker(self) -> None:
+        assert self._handler is not None
+        while True:
+            async with self._cond:
+                job = self._take()
+                while job is None:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), self._wakeup_in())
+                    except asyncio.TimeoutError:
+                        pass  # a deferred job is due
+                    job = self._take()
+            started = False
+            try:
+                try:
+                    started = await self._start(job)
+                except Exception:
+                    # e.g. "database is locked": the job stays persisted as queued
+                    log.exception("job %s of user %s could not be started", job.id, job.user_id)
+                    await self._put_back(job, START_RETRY_SECONDS)
+                if started:
+                    await self._handler(job)
+            except Exception:
+                # the handler reports errors to the user itself; a failed job is not retried
+                log.exception("job %s of user %s failed", job.id, job.user_id)
+            finally:
+                self._running.discard(job.user_id)
+                async with self._cond:
+                    self._cond.notify_all()  # the user's next job may be waiting
+            # a cancelled (shutting down) worker never gets here: its job stays persisted
+            if started:
+                await self.storage.job_done(job.id)
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class MemoryLRU:
+    """Size-bounded in-process LRU with per-entry expiry.
+
+    Sizes are whatever the caller reports (Storage passes the encoded JSON length).
+    Values are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (value, size, expires_at)
+        self._data: "OrderedDict[Hashable, Tuple[Any, int, float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, now: Optional[float] = None) -> Optional[Any]:
+        entry = self.get_entry(key, now=now)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key: Hashable, now: Optional[float] = None) -> Optional[Tuple[Any, float]]:
+        """(value, expires_at) of a live entry."""
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        value, _, expires_at = item
+        if (now if now is not None else time.time()) > expires_at:
+            self.pop(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value, expires_at
+
+    def set(self, key: Hashable, value: Any, size: int, expires_at: float) -> None:
+        self.pop(key)
+        if size > self.max_bytes:
+            return
+        self._data[key] = (value, size, expires_at)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, old_size, _) = self._data.popitem(last=False)
+            self.bytes -= old_size
+            self.evictions += 1
+
+    def touch(self, key: Hashable, expires_at: float) -> None:
+        item = self._data.get(key)
+        if item is not None:
+            self._data[key] = (item[0], item[1], expires_at)
+
+    def pop(self, key: Hashable) -> None:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.bytes -= item[1]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -1,32 +1,253 @@
 from __future__ import annotations
 
 import asyncio
+import hashlib
+import os
+import signal
+import socket
+import sqlite3
+import time
+from typing import Dict, Optional, Tuple
 
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
 
-from .config import get_settings
+from .analyzer_pool import AnalyzerPool
+from .config import Settings, get_settings
+from .jobs import JobQueue
+from .outbox import SendScheduler
 from .storage import Storage
 from .wb_client import WBClient
-from .bot import setup_handlers
+from .bot import make_job_handler, make_replaced_handler, setup_handlers
+
+# feedback endpoint health survives restarts as a regular cache entry
+WB_HEALTH_KEY = "wb:feedback_health"
+WB_HEALTH_TTL_SECONDS = 30 * 24 * 3600
+WB_HEALTH_SAVE_SECONDS = 60
+
+# prefork: a worker that dies sooner than this after its start is replaced only after this long
+WORKER_MIN_UPTIME_SECONDS = 5
+# prefork: how long the supervisor waits for the database lock when requeueing a dead worker's jobs
+REQUEUE_BUSY_TIMEOUT_SECONDS = 10
+
+
+async def _save_wb_health(storage: Storage, wb: WBClient) -> None:
+    await storage.cache_set(WB_HEALTH_KEY, wb.feedback_health.dump(), ttl_seconds=WB_HEALTH_TTL_SECONDS)
+
+
+async def _save_wb_health_loop(storage: Storage, wb: WBClient) -> None:
+    while True:
+        await asyncio.sleep(WB_HEALTH_SAVE_SECONDS)
+        try:
+            await _save_wb_health(storage, wb)
+        except Exception:
+            pass
+
+
+def _webhook_secret(settings: Settings) -> str:
+    # same in every worker and across restarts; Telegram allows [A-Za-z0-9_-], up to 256 chars
+    return settings.webhook_secret or hashlib.sha256(settings.bot_token.encode()).hexdigest()[:48]
+
+
+def _make_storage(settings: Settings, process_index: int = 0, process_count: int = 1) -> Storage:
+    return Storage(
+        settings.sqlite_path,
+        mem_cache_max_bytes=settings.mem_cache_max_bytes,
+        rate_snapshot_seconds=settings.rate_limit_snapshot_seconds,
+        compress=settings.cache_compress_min_bytes > 0,
+        compress_min_bytes=settings.cache_compress_min_bytes,
+        cache_max_bytes=settings.cache_max_bytes,
+        # one sweeper is enough for a shared database
+        sweep_seconds=settings.cache_sweep_seconds if process_index == 0 else 0,
+        stale_grace_seconds=settings.swr_max_stale_seconds,
+        derived_max_age_seconds=settings.derived_max_age_seconds,
+        process_index=process_index,
+        process_count=process_count,
+    )
+
+
+async def _prepare(settings: Settings) -> None:
+    """One-off work before serving: schema migrations, compression dictionary,
+    requeueing interrupted jobs, webhook registration. Done once by the parent
+    when preforking."""
+    storage = _make_storage(settings)
+    storage.sweep_seconds = 0
+    await storage.connect()
+    await storage.job_requeue_interrupted()
+    await storage.close()
+    if settings.webhook_url:
+        bot = Bot(token=settings.bot_token)
+        try:
+            await bot.set_webhook(settings.webhook_url + settings.webhook_path, secret_token=_webhook_secret(settings))
+        finally:
+            await bot.session.close()
+
+
+def _requeue_jobs_of(settings: Settings, pid: int) -> int:
+    """Queue the jobs a dead worker was running again; returns how many (0 on
+    failure). One plain statement: live workers keep writing meanwhile, and
+    nothing here may take the supervisor down."""
+    try:
+        db = sqlite3.connect(settings.sqlite_path, timeout=REQUEUE_BUSY_TIMEOUT_SECONDS)
+        try:
+            with db:
+                cur = db.execute("UPDATE jobs SET status='queued' WHERE status='running' AND owner_pid=?", (pid,))
+                return cur.rowcount
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return 0  # left running: no longer blocks its user after JOB_LEASE_SECONDS, requeued at next start
 
-async def main() -> None:
-    settings = get_settings()
 
-    storage = Storage(settings.sqlite_path)
+async def _serve_webhook(settings: Settings, dp: Dispatcher, bot: Bot, sock: Optional[socket.socket]) -> None:
+    app = web.Application()
+    # handle_in_background: Telegram gets its 200 before any handler runs
+    SimpleRequestHandler(dp, bot, handle_in_background=True, secret_token=_webhook_secret(settings)).register(
+        app, path=settings.webhook_path
+    )
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.SockSite(runner, sock) if sock is not None else web.TCPSite(runner, settings.web_host, settings.web_port)
+    await site.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await dp.emit_startup(bot=bot)
+        await stop.wait()
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await runner.cleanup()
+
+
+async def serve(
+    settings: Settings,
+    sock: Optional[socket.socket] = None,
+    process_index: int = 0,
+    process_count: int = 1,
+    recover_jobs: bool = True,
+) -> None:
+    storage = _make_storage(settings, process_index, process_count)
     await storage.connect()
 
-    wb = WBClient(dest=settings.wb_dest, locale=settings.wb_locale)
+    wb = WBClient(
+        dest=settings.wb_dest,
+        locale=settings.wb_locale,
+        hedge_delay_s=settings.feedback_hedge_delay_ms / 1000,
+    )
+    wb.feedback_health.load(await storage.cache_get(WB_HEALTH_KEY) or {})
+    health_task = asyncio.create_task(_save_wb_health_loop(storage, wb))
+
+    pool = AnalyzerPool(
+        workers=settings.analyzer_workers,
+        max_pending=settings.analyzer_max_pending,
+        inline_max_reviews=settings.analyzer_inline_max_reviews,
+    )
+    pool.start()
 
     bot = Bot(token=settings.bot_token, parse_mode=ParseMode.HTML)
+    bot.session.middleware(
+        SendScheduler(
+            per_second=settings.tg_send_per_second / process_count,
+            chat_interval_s=settings.tg_chat_interval_ms / 1000,
+        )
+    )
     dp = Dispatcher()
-    setup_handlers(dp, settings, storage, wb)
+    jobs = JobQueue(storage, workers=settings.job_workers, max_queued=settings.job_max_queued)
+    await jobs.start(
+        make_job_handler(bot, settings, storage, wb, pool),
+        recover=recover_jobs,
+        on_replaced=make_replaced_handler(bot),
+    )
+    setup_handlers(dp, settings, storage, jobs)
 
     try:
-        await dp.start_polling(bot)
+        if settings.webhook_url:
+            await _serve_webhook(settings, dp, bot, sock)
+        else:
+            await bot.delete_webhook()  # polling and a registered webhook exclude each other
+            await dp.start_polling(bot)
     finally:
+        await jobs.close()
+        health_task.cancel()
+        await _save_wb_health(storage, wb)
+        await pool.close()
         await wb.aclose()
+        await bot.session.close()
         await storage.close()
 
+
+def _prefork(settings: Settings) -> None:
+    """Webhook server in `web_workers` forked processes accepting on one socket.
+
+    Each worker has its own loop, caches and job queue over the shared SQLite
+    file; with process_count > 1 Storage and JobQueue keep per-user state (rate
+    limit, one job in flight, last prices) in SQL so the limits hold across workers.
+    A worker that dies is replaced, and the jobs it was running are queued again.
+    """
+    sock = socket.create_server((settings.web_host, settings.web_port), backlog=1024)
+    sock.set_inheritable(True)
+    asyncio.run(_prepare(settings))  # no event loop or sqlite thread may be alive at fork()
+
+    n = settings.web_workers
+
+    def spawn(i: int, recover_jobs: bool) -> int:
+        pid = os.fork()
+        if pid == 0:
+            # drop the supervisor's `forward` handler: _serve_webhook installs the worker's own
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                asyncio.run(serve(settings, sock, process_index=i, process_count=n, recover_jobs=recover_jobs))
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        return pid
+
+    # persisted jobs are picked up again by one process only
+    workers: Dict[int, Tuple[int, float]] = {spawn(i, i == 0): (i, time.monotonic()) for i in range(n)}
+    stopping = False
+
+    def forward(signum: int, _frame: object) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    while workers:
+        pid, _ = os.waitpid(-1, 0)
+        if pid not in workers:
+            continue
+        i, started = workers.pop(pid)
+        if stopping:
+            continue
+        _requeue_jobs_of(settings, pid)
+        if time.monotonic() - started < WORKER_MIN_UPTIME_SECONDS:
+            time.sleep(WORKER_MIN_UPTIME_SECONDS)  # crashing at startup: do not spin
+        if not stopping:
+            # its requeued jobs (and any it held only in memory) are recovered by the replacement
+            workers[spawn(i, True)] = (i, time.monotonic())
+    sock.close()
+
+
+def main() -> None:
+    settings = get_settings()
+    if settings.webhook_url and settings.web_workers > 1:
+        _prefork(settings)
+        return
+    asyncio.run(_prepare(settings))
+    asyncio.run(serve(settings))
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
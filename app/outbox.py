@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Dict, Hashable, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText
+from aiogram.methods.base import TelegramMethod, TelegramType
+
+from .ratelimit import TokenBucket
+
+
+class _Chat:
+    __slots__ = ("lock", "next_at")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()  # FIFO: one outbound call per chat at a time
+        self.next_at = 0.0
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """Bot session middleware pacing every chat-bound Bot API call.
+
+    - per chat: at most one call per `chat_interval_s`, in order;
+    - globally: a token bucket of `per_second` calls/s with a small burst;
+    - 429 with retry_after: the chat is paused that long and the call retried
+      (up to `max_retries` times);
+    - an edit still waiting for its slot is dropped once a newer edit of the
+      same message is queued: only the latest text is sent.
+    """
+
+    PRUNE_AT = 4096
+
+    def __init__(self, per_second: float = 30.0, chat_interval_s: float = 1.0, burst: float = 5.0, max_retries: int = 3):
+        self.rate = max(0.1, per_second)
+        self.burst = max(1.0, min(burst, self.rate))
+        self.chat_interval_s = chat_interval_s
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(self.burst, time.monotonic())
+        self._global = asyncio.Lock()
+        self._chats: Dict[Hashable, _Chat] = {}
+        # (chat_id, message_id) -> token of the newest pending edit
+        self._edits: Dict[Tuple[Hashable, int], object] = {}
+        self.superseded = 0
+        self.retried = 0
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Any:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        edit_key = None
+        token = object()
+        if isinstance(method, EditMessageText) and method.message_id is not None:
+            edit_key = (chat_id, method.message_id)
+            self._edits[edit_key] = token
+
+        chat = self._chat(chat_id)
+        try:
+            async with chat.lock:
+                attempt = 0
+                while True:
+                    delay = chat.next_at - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    if edit_key is not None and self._edits.get(edit_key) is not token:
+                        self.superseded += 1
+                        return True  # a newer edit of this message is queued behind us
+                    await self._global_slot()
+                    chat.next_at = time.monotonic() + self.chat_interval_s
+                    try:
+                        return await make_request(bot, method)
+                    except TelegramRetryAfter as e:
+                        if attempt >= self.max_retries:
+                            raise
+                        attempt += 1
+                        self.retried += 1
+                        chat.next_at = max(chat.next_at, time.monotonic() + e.retry_after)
+        finally:
+            if edit_key is not None and self._edits.get(edit_key) is token:
+                del self._edits[edit_key]
+
+    def _chat(self, chat_id: Hashable) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) >= self.PRUNE_AT:
+                now = time.monotonic()
+                idle = [k for k, c in self._chats.items() if not c.lock.locked() and c.next_at <= now]
+                for k in idle:
+                    del self._chats[k]
+            chat = self._chats[chat_id] = _Chat()
+        return chat
+
+    async def _global_slot(self) -> None:
+        async with self._global:
+            while not self._bucket.take(self.burst, self.rate, time.monotonic()):
+                await asyncio.sleep((1.0 - self._bucket.tokens) / self.rate)
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import time
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, tokens: float, updated_at: float):
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+    def refill(self, capacity: float, rate: float, now: float) -> None:
+        if now > self.updated_at:
+            self.tokens = min(capacity, self.tokens + (now - self.updated_at) * rate)
+            self.updated_at = now
+
+    def take(self, capacity: float, rate: float, now: float, cost: float = 1.0) -> bool:
+        self.refill(capacity, rate, now)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class RateLimiter:
+    """Per-key token buckets: `capacity` requests per `window_seconds`, refilled continuously.
+
+    A bucket idle for a full window is full again, i.e. equal to a missing one,
+    so idle keys are simply evicted. Buckets touched since the last snapshot are
+    tracked as dirty for periodic persistence.
+    """
+
+    def __init__(self, capacity: int, window_seconds: int):
+        self.capacity = float(max(1, capacity))
+        self.window_seconds = max(1, window_seconds)
+        self.rate = self.capacity / self.window_seconds
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+        self._dirty: Set[Hashable] = set()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def allow(self, key: Hashable, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        b = self._buckets.get(key)
+        if b is None:
+            b = self._buckets[key] = TokenBucket(self.capacity, now)
+        ok = b.take(self.capacity, self.rate, now)
+        if ok:
+            self._dirty.add(key)
+        return ok
+
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        cutoff = now - self.window_seconds
+        idle = [k for k, b in self._buckets.items() if b.updated_at <= cutoff]
+        for k in idle:
+            del self._buckets[k]
+            self._dirty.discard(k)
+        return len(idle)
+
+    def take_dirty(self) -> List[Tuple[Hashable, float, float]]:
+        rows = []
+        for k in self._dirty:
+            b = self._buckets.get(k)
+            if b is not None:
+                rows.append((k, b.tokens, b.updated_at))
+        self._dirty.clear()
+        return rows
+
+    def restore(self, rows: Iterable[Tuple[Hashable, float, float]], now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        for key, tokens, updated_at in rows:
+            if now - updated_at < self.window_seconds:
+                self._buckets[key] = TokenBucket(min(self.capacity, float(tokens)), float(updated_at))
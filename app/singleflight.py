@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one in-flight task.
+
+    The first caller starts the work; everyone arriving before it finishes awaits
+    the same result (or exception). A cancelled caller does not cancel the others.
+    """
+
+    def __init__(self) -> None:
+        self._inflight: Dict[Hashable, asyncio.Future[Any]] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        return await asyncio.shield(self.start(key, fn))
+
+    def start(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> "asyncio.Future[T]":
+        """The in-flight future for `key`, starting fn() if there is none; callers
+        arriving from now on join it at once, even before it first runs."""
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fn())
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda f, k=key: self._forget(k, f))
+        return fut
+
+    def running(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    def _forget(self, key: Hashable, fut: asyncio.Future[Any]) -> None:
+        if self._inflight.get(key) is fut:
+            del self._inflight[key]
+        if not fut.cancelled():
+            fut.exception()  # mark retrieved: all waiters may have been cancelled
@@ -1,23 +1,37 @@
 from __future__ import annotations
 
+import asyncio
 import json
+import logging
+import os
+import random
 import time
-from typing import Any, Optional, List, Dict
+from typing import Any, Optional, List, Dict, Sequence, Tuple, Union
 
 import aiosqlite
 
+from . import codec
+from .lru import MemoryLRU
+from .ratelimit import RateLimiter
+
+log = logging.getLogger(__name__)
+
 CREATE_SQL = '''
 CREATE TABLE IF NOT EXISTS cache (
   key TEXT PRIMARY KEY,
-  value_json TEXT NOT NULL,
+  value_json TEXT NOT NULL,  -- JSON text, a BLOB for bytes values, or a compressed BLOB (see codec)
   updated_at INTEGER NOT NULL,
-  ttl_seconds INTEGER NOT NULL
+  ttl_seconds INTEGER NOT NULL,
+  accessed_at INTEGER NOT NULL DEFAULT 0,  -- for LRU eviction; flushed in batches by the sweeper
+  size_bytes INTEGER NOT NULL DEFAULT 0    -- stored size of value_json
 );
 
-CREATE TABLE IF NOT EXISTS rate_limit (
+-- rate limiting lives in memory (token buckets); this is its periodic snapshot
+DROP TABLE IF EXISTS rate_limit;
+CREATE TABLE IF NOT EXISTS rate_bucket (
   user_id INTEGER PRIMARY KEY,
-  window_start INTEGER NOT NULL,
-  count INTEGER NOT NULL
+  tokens REAL NOT NULL,
+  updated_at REAL NOT NULL
 );
 
 -- price snapshots: we build history ourselves (from the moment the bot runs)
@@ -29,109 +43,856 @@ CREATE TABLE IF NOT EXISTS price_history (
   product_u INTEGER
 );
 
+-- nmId -> root (imt) id, learned from every card we fetched
+CREATE TABLE IF NOT EXISTS nm_root (
+  nmid INTEGER PRIMARY KEY,
+  root_id INTEGER NOT NULL,
+  updated_at INTEGER NOT NULL
+);
+
+-- latest analysis per root; valid only for the same review content and analyzer version
+CREATE TABLE IF NOT EXISTS analysis_cache (
+  root_id INTEGER PRIMARY KEY,
+  content_hash TEXT NOT NULL,
+  analyzer_version INTEGER NOT NULL,
+  result_json TEXT NOT NULL,
+  updated_at INTEGER NOT NULL
+);
+
+-- zlib preset dictionaries for compressed cache values; old versions stay readable
+CREATE TABLE IF NOT EXISTS zdict (
+  version INTEGER PRIMARY KEY,
+  dict BLOB NOT NULL,
+  created_at INTEGER NOT NULL
+);
+
+-- analysis requests waiting for (or interrupted in) the job queue; see jobs.JobQueue
+CREATE TABLE IF NOT EXISTS jobs (
+  id INTEGER PRIMARY KEY,
+  user_id INTEGER NOT NULL,
+  chat_id INTEGER NOT NULL,
+  payload_json TEXT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'queued',  -- queued | running
+  attempts INTEGER NOT NULL DEFAULT 0,
+  created_at INTEGER NOT NULL,
+  owner_pid INTEGER NOT NULL DEFAULT 0,   -- process running it (job_claim)
+  started_at INTEGER NOT NULL DEFAULT 0
+);
+
 CREATE INDEX IF NOT EXISTS idx_price_history_nmid_ts ON price_history(nmid, ts DESC);
+-- for the sweeper's age cutoff
+CREATE INDEX IF NOT EXISTS idx_analysis_cache_updated ON analysis_cache(updated_at);
+CREATE INDEX IF NOT EXISTS idx_nm_root_updated ON nm_root(updated_at);
 '''
 
+def _encode_value(value: Any) -> Union[str, bytes, codec.RawJSON]:
+    """bytes go into the cache table as a BLOB unchanged (the caller owns the
+    format); RawJSON keeps its bytes (framed by the codec, see Storage._pack);
+    anything else is serialized to JSON text."""
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    if isinstance(value, codec.RawJSON):
+        return value  # already JSON: no re-serialization
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _decode_value(raw: Union[str, bytes, codec.RawJSON]) -> Any:
+    if isinstance(raw, codec.RawJSON):
+        return raw.value
+    if isinstance(raw, bytes):
+        return raw
+    return json.loads(raw)
+
+
+def _raw_size(raw: Union[str, bytes, codec.RawJSON]) -> int:
+    if isinstance(raw, codec.RawJSON):
+        return len(raw)
+    return len(raw) if isinstance(raw, bytes) else len(raw.encode("utf-8"))
+
+
+# a dictionary is trained (at connect or by the sweeper) once this many JSON values are cached
+ZDICT_MIN_SAMPLES = 50
+ZDICT_SAMPLE_SIZE = 300
+# rowids drawn per wanted sample: deletes leave holes in the rowid range
+ZDICT_OVERSAMPLE = 3
+# the sweeper trains a fresh one when the newest is older than this
+ZDICT_RETRAIN_SECONDS = 7 * 24 * 3600
+# compress / decompress bigger values in a thread so the event loop is not blocked
+COMPRESS_IN_THREAD_BYTES = 256 * 1024
+UNPACK_IN_THREAD_BYTES = 64 * 1024  # stored size, i.e. usually compressed
+
+# cache sweeper: rows per DELETE batch, free pages returned per incremental vacuum
+SWEEP_BATCH = 500
+VACUUM_PAGES = 512
+# after the size cap is hit, evict down to this fraction of it
+SWEEP_LOW_WATERMARK = 0.9
+# cache read times go to accessed_at (for the LRU) at least this often, in every process
+ACCESS_FLUSH_SECONDS = 60
+
+# shared database: a running job older than this no longer blocks its user's next
+# one (its process is presumed dead; analyses take seconds)
+JOB_LEASE_SECONDS = 300
+
+# nmIds per IN (...) when seeding the last-price map
+PRICE_SEED_CHUNK = 500
+# bound parameters per statement (SQLITE_MAX_VARIABLE_NUMBER of older builds)
+SQL_MAX_PARAMS = 999
+
+# analysis results are immutable per content hash; the memory tier just needs some bound
+ANALYSIS_MEM_TTL_SECONDS = 24 * 3600
+
+# token bucket take in one statement (see ratelimit.TokenBucket); a row comes back iff allowed
+RATE_TAKE_SQL = """
+INSERT INTO rate_bucket(user_id, tokens, updated_at) VALUES(:user, :cap - 1, :now)
+ON CONFLICT(user_id) DO UPDATE SET
+  tokens = MIN(:cap, tokens + MAX(0, :now - updated_at) * :rate) - 1,
+  updated_at = MAX(updated_at, :now)
+WHERE MIN(:cap, tokens + MAX(0, :now - updated_at) * :rate) >= 1
+RETURNING tokens
+"""
+
+# price snapshot unless the latest recorded one for the nmId is the same price
+PRICE_INSERT_IF_CHANGED_SQL = """
+INSERT INTO price_history(nmid, ts, basic_u, product_u) SELECT ?1, ?2, ?3, ?4
+WHERE NOT EXISTS (
+  SELECT 1 FROM (SELECT basic_u, product_u FROM price_history WHERE nmid = ?1 ORDER BY ts DESC, id DESC LIMIT 1)
+  WHERE basic_u IS ?3 AND product_u IS ?4
+)
+"""
+
+# (sql, params, executemany?, fetch rows?, completion future or None for fire-and-forget)
+_WriteOp = Tuple[str, Any, bool, bool, Optional["asyncio.Future[Any]"]]
+
+
 class Storage:
-    def __init__(self, sqlite_path: str):
+    """SQLite state in WAL mode.
+
+    All mutations go through one writer task that group-commits a batch every
+    `flush_interval_ms` or every `batch_size` statements; reads use a separate
+    connection, so they never queue behind writes.
+    """
+
+    def __init__(
+        self,
+        sqlite_path: str,
+        mem_cache_max_bytes: int = 64 * 1024 * 1024,
+        flush_interval_ms: int = 5,
+        batch_size: int = 200,
+        rate_snapshot_seconds: int = 30,
+        compress: bool = True,
+        compress_min_bytes: int = 512,
+        cache_max_bytes: int = 0,
+        sweep_seconds: int = 300,
+        stale_grace_seconds: int = 0,
+        derived_max_age_seconds: int = 0,
+        process_index: int = 0,
+        process_count: int = 1,
+    ):
         self.sqlite_path = sqlite_path
+        # several processes may share the file (prefork): ids they mint must not collide
+        self.process_index = process_index
+        self.process_count = max(1, process_count)
+        self.flush_interval_ms = flush_interval_ms
+        self.batch_size = batch_size
         self._db: Optional[aiosqlite.Connection] = None
+        self._rdb: Optional[aiosqlite.Connection] = None
+        self._writes: "asyncio.Queue[Optional[_WriteOp]]" = asyncio.Queue()
+        self._writer_task: Optional[asyncio.Task[None]] = None
+        # decoded hot entries in front of the cache table (write-through)
+        self.mem = MemoryLRU(max_bytes=mem_cache_max_bytes)
+        # in-memory admission control, snapshotted to rate_bucket periodically
+        self.rate_snapshot_seconds = rate_snapshot_seconds
+        self._rate: Optional[RateLimiter] = None
+        self._rate_rows: List[Tuple[int, float, float]] = []
+        self._rate_task: Optional[asyncio.Task[None]] = None
+        self._roots: Dict[int, int] = {}
+        # nmid -> last recorded (basic_u, product_u), filled lazily from price_history
+        self._last_price: Dict[int, Tuple[Optional[int], Optional[int]]] = {}
+        self._job_seq = 0  # job ids: k * process_count + process_index
+        # cache value compression (see codec): all known dictionaries, newest used for writes
+        self.compress = compress
+        self.compress_min_bytes = compress_min_bytes
+        self._zdicts: Dict[int, bytes] = {}
+        self._zdict_version = 0
+        self._zdict_trained_at = 0
+        # background sweeper: expired rows (kept `stale_grace_seconds` for SWR), size cap (0 = none)
+        self.cache_max_bytes = cache_max_bytes
+        self.sweep_seconds = sweep_seconds
+        self.stale_grace_seconds = stale_grace_seconds
+        # analysis results and nmId -> root rows not written for this long are swept too (0 = kept)
+        self.derived_max_age_seconds = derived_max_age_seconds
+        self._accessed: Dict[str, int] = {}
+        self._sweep_task: Optional[asyncio.Task[None]] = None
+        self._access_task: Optional[asyncio.Task[None]] = None
 
     async def connect(self) -> None:
         self._db = await aiosqlite.connect(self.sqlite_path)
+        await self._enable_incremental_vacuum()
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute("PRAGMA synchronous=NORMAL")
         await self._db.executescript(CREATE_SQL)
+        await self._migrate_cache()
+        await self._migrate_jobs()
         await self._db.commit()
+        self._rdb = await aiosqlite.connect(self.sqlite_path)
+        self._writer_task = asyncio.create_task(self._writer())
+
+        cur = await self._rdb.execute("SELECT user_id, tokens, updated_at FROM rate_bucket")
+        self._rate_rows = [(int(u), float(t), float(ts)) for (u, t, ts) in await cur.fetchall()]
+        await cur.close()
+        self._rate_task = asyncio.create_task(self._rate_snapshot_loop())
+
+        cur = await self._rdb.execute("SELECT COALESCE(MAX(id), 0) FROM jobs")
+        (max_job_id,) = await cur.fetchone()
+        await cur.close()
+        self._job_seq = int(max_job_id) // self.process_count
+
+        await self._load_zdicts()
+        if self.compress and not self._zdict_version:
+            await self.train_zdict(min_samples=ZDICT_MIN_SAMPLES)
+
+        if self.sweep_seconds > 0:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+        self._access_task = asyncio.create_task(self._access_flush_loop())
+
+    async def _enable_incremental_vacuum(self) -> None:
+        cur = await self.db.execute("PRAGMA auto_vacuum")
+        (mode,) = await cur.fetchone()
+        await cur.close()
+        if int(mode) == 2:
+            return
+        await self.db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cur = await self.db.execute("SELECT count(*) FROM sqlite_master")
+        (tables,) = await cur.fetchone()
+        await cur.close()
+        if tables:
+            # existing file: the mode only applies after a full rebuild, which is not done
+            # at startup (it may take long on a big file); until then freed pages stay in it
+            log.warning(
+                "%s is not in incremental auto-vacuum mode; the cache sweeper cannot shrink it. "
+                "Stop the bot and run `python -m app.vacuum %s` once.",
+                self.sqlite_path,
+                self.sqlite_path,
+            )
+
+    async def _migrate_jobs(self) -> None:
+        cur = await self.db.execute("PRAGMA table_info(jobs)")
+        columns = {row[1] for row in await cur.fetchall()}
+        await cur.close()
+        if "owner_pid" not in columns:
+            await self.db.execute("ALTER TABLE jobs ADD COLUMN owner_pid INTEGER NOT NULL DEFAULT 0")
+            await self.db.execute("ALTER TABLE jobs ADD COLUMN started_at INTEGER NOT NULL DEFAULT 0")
+
+    async def _migrate_cache(self) -> None:
+        cur = await self.db.execute("PRAGMA table_info(cache)")
+        columns = {row[1] for row in await cur.fetchall()}
+        await cur.close()
+        if "accessed_at" not in columns:
+            await self.db.execute("ALTER TABLE cache ADD COLUMN accessed_at INTEGER NOT NULL DEFAULT 0")
+            await self.db.execute("ALTER TABLE cache ADD COLUMN size_bytes INTEGER NOT NULL DEFAULT 0")
+            await self.db.execute(
+                "UPDATE cache SET accessed_at=updated_at, size_bytes=length(CAST(value_json AS BLOB))"
+            )
+        # both columns sit after the (possibly overflowing) value: keep the sweeper on indexes
+        await self.db.execute("CREATE INDEX IF NOT EXISTS idx_cache_expires ON cache(updated_at + ttl_seconds)")
+        await self.db.execute("CREATE INDEX IF NOT EXISTS idx_cache_lru ON cache(accessed_at, size_bytes)")
 
     async def close(self) -> None:
+        if self._sweep_task:
+            self._sweep_task.cancel()
+            try:
+                await self._sweep_task
+            except asyncio.CancelledError:
+                pass
+            self._sweep_task = None
+        if self._access_task:
+            self._access_task.cancel()
+            try:
+                await self._access_task
+            except asyncio.CancelledError:
+                pass
+            self._access_task = None
+            await self._flush_access()
+        if self._rate_task:
+            self._rate_task.cancel()
+            try:
+                await self._rate_task
+            except asyncio.CancelledError:
+                pass
+            self._rate_task = None
+            await self.rate_limit_snapshot()
+        if self._writer_task:
+            await self._writes.put(None)  # drain pending writes, then stop
+            await self._writer_task
+            self._writer_task = None
+        if self._rdb:
+            await self._rdb.close()
+            self._rdb = None
         if self._db:
             await self._db.close()
             self._db = None
 
+    @property
+    def shared(self) -> bool:
+        """Other processes use the same file: in-memory state may be stale or partial."""
+        return self.process_count > 1
+
     @property
     def db(self) -> aiosqlite.Connection:
+        """Write connection: owned by the writer task."""
         if not self._db:
             raise RuntimeError("Storage not connected")
         return self._db
 
+    @property
+    def rdb(self) -> aiosqlite.Connection:
+        """Read connection: sees every committed write (WAL), never waits for the writer."""
+        if not self._rdb:
+            raise RuntimeError("Storage not connected")
+        return self._rdb
+
+    # --- writer ---
+    async def _write(
+        self, sql: str, params: Any = (), many: bool = False, wait: bool = True, fetch: bool = False
+    ) -> Optional[List[Any]]:
+        """Queue a mutation. With wait=True returns once the batch holding it is committed;
+        with fetch=True (implies wait) returns the statement's rows, e.g. from RETURNING."""
+        wait = wait or fetch
+        fut: Optional[asyncio.Future[Any]] = asyncio.get_running_loop().create_future() if wait else None
+        await self._writes.put((sql, params, many, fetch, fut))
+        if fut is not None:
+            return await fut
+        return None
+
+    async def _writer(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            op = await self._writes.get()
+            if op is None:
+                break
+            batch: List[_WriteOp] = [op]
+            deadline = loop.time() + self.flush_interval_ms / 1000
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                try:
+                    nxt = self._writes.get_nowait() if timeout <= 0 else await asyncio.wait_for(self._writes.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if nxt is None:
+                    stopping = True
+                    break
+                batch.append(nxt)
+            await self._flush(batch)
+
+    async def _flush(self, batch: Sequence[_WriteOp]) -> None:
+        errors: List[Optional[BaseException]] = []
+        results: List[Optional[List[Any]]] = []
+        for sql, params, many, fetch, _ in batch:
+            rows = None
+            try:
+                if many:
+                    await self.db.executemany(sql, params)
+                elif sql.startswith("PRAGMA"):
+                    await self.db.executescript(sql)  # runs to completion (incremental_vacuum frees a page per step)
+                else:
+                    cur = await self.db.execute(sql, params)
+                    if fetch:
+                        rows = list(await cur.fetchall())
+                    await cur.close()
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+            results.append(rows)
+        try:
+            await self.db.commit()
+        except Exception as e:
+            errors = [err or e for err in errors]
+        for (_, _, _, _, fut), err, rows in zip(batch, errors, results):
+            if fut is None or fut.done():
+                continue
+            if err is None:
+                fut.set_result(rows)
+            else:
+                fut.set_exception(err)
+
+    # --- cache value codec ---
+    async def _pack(self, raw: Union[str, bytes, codec.RawJSON]) -> Union[str, bytes]:
+        size = _raw_size(raw)
+        if self.compress and size >= self.compress_min_bytes:
+            version = self._zdict_version
+            args = (raw, version, self._zdicts.get(version, b""))
+            if size >= COMPRESS_IN_THREAD_BYTES:
+                packed = await asyncio.to_thread(codec.compress_value, *args)
+            else:
+                packed = codec.compress_value(*args)
+            if len(packed) < size:
+                return packed
+        if isinstance(raw, codec.RawJSON):
+            return codec.compress_value(raw, level=0)  # stored as is, but marked as JSON
+        return raw
+
+    async def _unpack(self, stored: Union[str, bytes]) -> Tuple[Any, int]:
+        """(value, uncompressed size); ValueError if the row cannot be decoded."""
+
+        def unpack() -> Tuple[Any, int]:
+            raw = codec.decompress_value(stored, self._zdicts) if codec.is_compressed(stored) else stored
+            return _decode_value(raw), _raw_size(raw)
+
+        async def run() -> Tuple[Any, int]:
+            if len(stored) >= UNPACK_IN_THREAD_BYTES:
+                return await asyncio.to_thread(unpack)
+            return unpack()
+
+        try:
+            return await run()
+        except ValueError:
+            # maybe packed with a dictionary another process trained since we loaded ours
+            if not await self._load_zdicts():
+                raise
+            return await run()
+
+    async def _load_zdicts(self) -> bool:
+        """Pick up dictionaries added to the zdict table; True if there were new ones."""
+        cur = await self.rdb.execute(
+            "SELECT version, dict, created_at FROM zdict WHERE version > ?", (max(self._zdicts, default=0),)
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+        for version, zdict, created_at in rows:
+            self._zdicts[int(version)] = bytes(zdict)
+            if int(version) > self._zdict_version:
+                self._zdict_version, self._zdict_trained_at = int(version), int(created_at)
+        return bool(rows)
+
+    @staticmethod
+    async def _mem_value(value: Any) -> Any:
+        return await value.parse() if isinstance(value, codec.RawJSON) else value
+
+    async def train_zdict(self, sample_size: int = ZDICT_SAMPLE_SIZE, min_samples: int = 1) -> int:
+        """Train a new preset dictionary from cached JSON values; returns its version (0 = not enough data)."""
+        # random rowids, not ORDER BY random(): that would read every value in the table
+        cur = await self.rdb.execute("SELECT MIN(rowid), MAX(rowid) FROM cache")
+        lo, hi = await cur.fetchone()
+        await cur.close()
+        if lo is None:
+            return 0
+        span = range(int(lo), int(hi) + 1)
+        rowids = random.sample(span, min(len(span), int(sample_size) * ZDICT_OVERSAMPLE, SQL_MAX_PARAMS))
+        marks = ",".join("?" * len(rowids))
+        cur = await self.rdb.execute(f"SELECT value_json FROM cache WHERE rowid IN ({marks})", rowids)
+        rows = (await cur.fetchall())[:int(sample_size)]
+        await cur.close()
+        samples: List[str] = []
+        for (stored,) in rows:
+            try:
+                raw = codec.decompress_value(stored, self._zdicts) if codec.is_compressed(stored) else stored
+            except ValueError:
+                continue
+            if isinstance(raw, str):
+                samples.append(raw)
+            elif isinstance(raw, codec.RawJSON):
+                samples.append(raw.text())
+        if len(samples) < min_samples:
+            return 0
+        zdict = await asyncio.to_thread(codec.train_zdict, samples)
+        if not zdict:
+            return 0
+        version = max(self._zdicts, default=0) + 1
+        now = int(time.time())
+        await self._write("INSERT INTO zdict(version, dict, created_at) VALUES(?,?,?)", (version, zdict, now))
+        self._zdicts[version] = zdict
+        self._zdict_version, self._zdict_trained_at = version, now
+        return version
+
     # --- cache ---
     async def cache_get(self, key: str) -> Optional[Any]:
         now = int(time.time())
-        cur = await self.db.execute("SELECT value_json, updated_at, ttl_seconds FROM cache WHERE key=?", (key,))
+        value = self.mem.get(key, now=now)
+        if value is not None:
+            self._accessed[key] = now
+            return await self._mem_value(value)
+
+        cur = await self.rdb.execute("SELECT value_json, updated_at, ttl_seconds FROM cache WHERE key=?", (key,))
         row = await cur.fetchone()
         await cur.close()
         if not row:
             return None
-        value_json, updated_at, ttl_seconds = row
+        stored, updated_at, ttl_seconds = row
         if now - int(updated_at) > int(ttl_seconds):
-            await self.db.execute("DELETE FROM cache WHERE key=?", (key,))
-            await self.db.commit()
+            await self._write("DELETE FROM cache WHERE key=?", (key,), wait=False)
             return None
         try:
-            return json.loads(value_json)
-        except json.JSONDecodeError:
+            value, size = await self._unpack(stored)
+        except ValueError:
+            return None
+        self.mem.set(key, value, size=size, expires_at=int(updated_at) + int(ttl_seconds))
+        self._accessed[key] = now
+        return value
+
+    async def cache_get_stale(self, key: str) -> Optional[Tuple[Any, int]]:
+        """(value, expires_at) without dropping expired rows: for revalidation and
+        stale-while-revalidate, where the caller decides what to do with old values."""
+        now = int(time.time())
+        entry = self.mem.get_entry(key, now=now)
+        if entry is not None:
+            self._accessed[key] = now
+            return await self._mem_value(entry[0]), int(entry[1])
+
+        cur = await self.rdb.execute("SELECT value_json, updated_at, ttl_seconds FROM cache WHERE key=?", (key,))
+        row = await cur.fetchone()
+        await cur.close()
+        if not row:
+            return None
+        stored, updated_at, ttl_seconds = row
+        try:
+            value, size = await self._unpack(stored)
+        except ValueError:
             return None
+        expires_at = int(updated_at) + int(ttl_seconds)
+        if now <= expires_at:
+            self.mem.set(key, value, size=size, expires_at=expires_at)
+        self._accessed[key] = now
+        return value, expires_at
+
+    async def cache_touch(self, key: str, ttl_seconds: int) -> None:
+        """Restart an entry's TTL without rewriting its value (revalidated as unchanged)."""
+        now = int(time.time())
+        await self._write("UPDATE cache SET updated_at=?, ttl_seconds=? WHERE key=?", (now, int(ttl_seconds), key))
+        self.mem.touch(key, expires_at=now + int(ttl_seconds))
 
     async def cache_set(self, key: str, value: Any, ttl_seconds: int) -> None:
         now = int(time.time())
-        value_json = json.dumps(value, ensure_ascii=False)
-        await self.db.execute(
-            "INSERT INTO cache(key, value_json, updated_at, ttl_seconds) VALUES(?,?,?,?) "
-            "ON CONFLICT(key) DO UPDATE SET value_json=excluded.value_json, updated_at=excluded.updated_at, ttl_seconds=excluded.ttl_seconds",
-            (key, value_json, now, int(ttl_seconds)),
+        raw = _encode_value(value)
+        stored = await self._pack(raw)
+        await self._write(
+            "INSERT INTO cache(key, value_json, updated_at, ttl_seconds, accessed_at, size_bytes) VALUES(?,?,?,?,?,?) "
+            "ON CONFLICT(key) DO UPDATE SET value_json=excluded.value_json, updated_at=excluded.updated_at, "
+            "ttl_seconds=excluded.ttl_seconds, accessed_at=excluded.accessed_at, size_bytes=excluded.size_bytes",
+            (key, stored, now, int(ttl_seconds), now, _raw_size(stored)),
         )
-        await self.db.commit()
+        self._accessed.pop(key, None)
+        self.mem.set(key, value, size=_raw_size(raw), expires_at=now + int(ttl_seconds))
 
-    # --- rate limit ---
-    async def rate_limit_allow(self, user_id: int, window_seconds: int, max_requests: int) -> bool:
-        now = int(time.time())
-        cur = await self.db.execute("SELECT window_start, count FROM rate_limit WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
+    # --- cache sweeper ---
+    async def _flush_access(self) -> None:
+        if not self._accessed:
+            return
+        rows = [(ts, key, ts) for key, ts in self._accessed.items()]
+        self._accessed = {}
+        await self._write("UPDATE cache SET accessed_at=? WHERE key=? AND accessed_at<?", rows, many=True)
+
+    async def _delete_keys(self, keys: List[str]) -> None:
+        await self._write("DELETE FROM cache WHERE key=?", [(k,) for k in keys], many=True)
+        for k in keys:
+            self.mem.pop(k)
+            self._accessed.pop(k, None)
+
+    async def sweep(self) -> Dict[str, int]:
+        """One sweeper pass: expired rows, then the size cap (LRU), then analysis
+        results and nmId -> root rows older than `derived_max_age_seconds`, then a
+        bounded incremental vacuum. Works in SWEEP_BATCH-sized statements so the
+        writer never holds one long transaction. Last, with compression on, a
+        dictionary is trained if there is none yet or the newest is
+        ZDICT_RETRAIN_SECONDS old."""
+        await self._flush_access()
+        expired = evicted = 0
+
+        cutoff = int(time.time()) - self.stale_grace_seconds
+        while True:
+            cur = await self.rdb.execute(
+                "SELECT key FROM cache WHERE updated_at + ttl_seconds < ? LIMIT ?", (cutoff, SWEEP_BATCH)
+            )
+            keys = [k for (k,) in await cur.fetchall()]
+            await cur.close()
+            if keys:
+                await self._delete_keys(keys)
+                expired += len(keys)
+            if len(keys) < SWEEP_BATCH:
+                break
+
+        if self.cache_max_bytes > 0:
+            cur = await self.rdb.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM cache")
+            (total,) = await cur.fetchone()
+            await cur.close()
+            target = int(self.cache_max_bytes * SWEEP_LOW_WATERMARK)
+            while total > self.cache_max_bytes or (evicted and total > target):
+                cur = await self.rdb.execute(
+                    "SELECT key, size_bytes FROM cache ORDER BY accessed_at LIMIT ?", (SWEEP_BATCH,)
+                )
+                rows = await cur.fetchall()
+                await cur.close()
+                if not rows:
+                    break
+                keys = []
+                for key, size in rows:
+                    if total <= target:
+                        break
+                    keys.append(key)
+                    total -= int(size)
+                await self._delete_keys(keys)
+                evicted += len(keys)
+
+        aged = 0
+        if self.derived_max_age_seconds > 0:
+            cutoff = int(time.time()) - self.derived_max_age_seconds
+            for table in ("analysis_cache", "nm_root"):
+                while True:
+                    rows = await self._write(
+                        f"DELETE FROM {table} WHERE rowid IN "
+                        f"(SELECT rowid FROM {table} WHERE updated_at < ? LIMIT ?) RETURNING 1",
+                        (cutoff, SWEEP_BATCH),
+                        fetch=True,
+                    )
+                    aged += len(rows or [])
+                    if len(rows or []) < SWEEP_BATCH:
+                        break
+            if aged:
+                self._roots.clear()  # unchanged roots are not rewritten while remembered here
+
+        cur = await self.rdb.execute("PRAGMA freelist_count")
+        (free_pages,) = await cur.fetchone()
         await cur.close()
+        if free_pages:
+            await self._write(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+
+        zdict_version = 0
+        if self.compress and time.time() - self._zdict_trained_at >= ZDICT_RETRAIN_SECONDS:
+            zdict_version = await self.train_zdict(min_samples=ZDICT_MIN_SAMPLES)
+        return {"expired": expired, "evicted": evicted, "aged": aged, "free_pages": int(free_pages), "zdict": zdict_version}
+
+    async def _access_flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(ACCESS_FLUSH_SECONDS)
+            try:
+                await self._flush_access()
+            except Exception:
+                pass  # best effort: the next tick retries
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_seconds)
+            try:
+                await self.sweep()
+            except Exception:
+                pass
 
+    # --- analysis results ---
+    async def analysis_get(self, root_id: int, content_hash: str, version: int) -> Optional[Dict[str, Any]]:
+        mem_key = f"analysis:{root_id}:{content_hash}:{version}"
+        value = self.mem.get(mem_key)
+        if value is not None:
+            return value
+        cur = await self.rdb.execute(
+            "SELECT result_json FROM analysis_cache WHERE root_id=? AND content_hash=? AND analyzer_version=?",
+            (int(root_id), content_hash, int(version)),
+        )
+        row = await cur.fetchone()
+        await cur.close()
         if not row:
-            await self.db.execute("INSERT INTO rate_limit(user_id, window_start, count) VALUES(?,?,?)", (user_id, now, 1))
-            await self.db.commit()
-            return True
+            return None
+        try:
+            value = json.loads(row[0])
+        except json.JSONDecodeError:
+            return None
+        self.mem.set(mem_key, value, size=len(row[0].encode("utf-8")), expires_at=time.time() + ANALYSIS_MEM_TTL_SECONDS)
+        return value
 
-        window_start, count = int(row[0]), int(row[1])
-        if now - window_start >= window_seconds:
-            await self.db.execute("UPDATE rate_limit SET window_start=?, count=? WHERE user_id=?", (now, 1, user_id))
-            await self.db.commit()
-            return True
+    async def analysis_set(self, root_id: int, content_hash: str, version: int, result: Dict[str, Any]) -> None:
+        now = int(time.time())
+        result_json = json.dumps(result, ensure_ascii=False)
+        await self._write(
+            "INSERT INTO analysis_cache(root_id, content_hash, analyzer_version, result_json, updated_at) VALUES(?,?,?,?,?) "
+            "ON CONFLICT(root_id) DO UPDATE SET content_hash=excluded.content_hash, "
+            "analyzer_version=excluded.analyzer_version, result_json=excluded.result_json, updated_at=excluded.updated_at",
+            (int(root_id), content_hash, int(version), result_json, now),
+            wait=False,
+        )
+        self.mem.set(
+            f"analysis:{root_id}:{content_hash}:{version}",
+            result,
+            size=len(result_json.encode("utf-8")),
+            expires_at=now + ANALYSIS_MEM_TTL_SECONDS,
+        )
+
+    # --- rate limit ---
+    async def rate_limit_allow(self, user_id: int, window_seconds: int, max_requests: int) -> bool:
+        rl = self._rate
+        if rl is None or rl.window_seconds != window_seconds or rl.capacity != max_requests:
+            rl = self._rate = RateLimiter(capacity=max_requests, window_seconds=window_seconds)
+            rl.restore(self._rate_rows)
+            self._rate_rows = []
+        if self.shared:
+            # a user's requests reach any process: take the token from the shared row
+            rows = await self._write(
+                RATE_TAKE_SQL, {"user": int(user_id), "cap": rl.capacity, "rate": rl.rate, "now": time.time()}, fetch=True
+            )
+            return bool(rows)
+        return rl.allow(user_id)
 
-        if count >= max_requests:
-            return False
+    async def rate_limit_snapshot(self) -> None:
+        """Persist buckets touched since the last snapshot and forget idle users."""
+        rl = self._rate
+        if rl is None:
+            return
+        now = time.time()
+        rl.evict_idle(now)
+        rows = rl.take_dirty()
+        if rows:
+            await self._write(
+                "INSERT INTO rate_bucket(user_id, tokens, updated_at) VALUES(?,?,?) "
+                "ON CONFLICT(user_id) DO UPDATE SET tokens=excluded.tokens, updated_at=excluded.updated_at",
+                rows,
+                many=True,
+            )
+        await self._write("DELETE FROM rate_bucket WHERE updated_at <= ?", (now - rl.window_seconds,))
 
-        await self.db.execute("UPDATE rate_limit SET count=count+1 WHERE user_id=?", (user_id,))
-        await self.db.commit()
-        return True
+    async def _rate_snapshot_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.rate_snapshot_seconds)
+            try:
+                await self.rate_limit_snapshot()
+            except Exception:
+                pass  # best effort: the next tick retries
+
+    # --- nmId -> root ---
+    async def root_get(self, nmid: int) -> Optional[int]:
+        root = self._roots.get(int(nmid))
+        if root is not None:
+            return root
+        cur = await self.rdb.execute("SELECT root_id FROM nm_root WHERE nmid=?", (int(nmid),))
+        row = await cur.fetchone()
+        await cur.close()
+        if not row:
+            return None
+        self._roots[int(nmid)] = int(row[0])
+        return int(row[0])
+
+    async def root_set(self, nmid: int, root_id: int) -> None:
+        if self._roots.get(int(nmid)) == int(root_id):
+            return
+        self._roots[int(nmid)] = int(root_id)
+        await self._write(
+            "INSERT INTO nm_root(nmid, root_id, updated_at) VALUES(?,?,?) "
+            "ON CONFLICT(nmid) DO UPDATE SET root_id=excluded.root_id, updated_at=excluded.updated_at",
+            (int(nmid), int(root_id), int(time.time())),
+            wait=False,
+        )
 
     # --- price history ---
     async def price_add_snapshot(self, nmid: int, basic_u: Optional[int], product_u: Optional[int], ts: Optional[int] = None) -> None:
+        await self.price_add_snapshots([(nmid, basic_u, product_u)], ts=ts)
+
+    async def price_add_snapshots(
+        self, prices: Sequence[Tuple[int, Optional[int], Optional[int]]], ts: Optional[int] = None
+    ) -> int:
+        """Append (nmid, basic_u, product_u) snapshots whose price differs from the
+        last one recorded; returns how many were written. The last price per nmId
+        lives in memory (seeded from the table on first sight), so unchanged
+        prices cost no SQL and changed ones go out as one executemany.
+
+        With other processes writing prices too, the map is reseeded on every
+        call and each insert re-checks the latest row itself."""
         ts_i = int(ts or time.time())
+        if self.shared:
+            self._last_price.clear()
+        unseen = list({int(nmid) for nmid, _, _ in prices} - self._last_price.keys())
+        for i in range(0, len(unseen), PRICE_SEED_CHUNK):
+            await self._seed_last_prices(unseen[i:i + PRICE_SEED_CHUNK])
 
-        cur = await self.db.execute(
-            "SELECT basic_u, product_u FROM price_history WHERE nmid=? ORDER BY ts DESC LIMIT 1",
-            (int(nmid),),
-        )
-        row = await cur.fetchone()
-        await cur.close()
-        if row:
-            last_basic, last_product = row
-            if (last_basic == basic_u) and (last_product == product_u):
-                return
+        rows = []
+        for nmid, basic_u, product_u in prices:
+            price = (basic_u, product_u)
+            if self._last_price.get(int(nmid)) == price:
+                continue
+            self._last_price[int(nmid)] = price
+            rows.append((int(nmid), ts_i, basic_u, product_u))
+        if rows:
+            sql = (
+                PRICE_INSERT_IF_CHANGED_SQL
+                if self.shared
+                else "INSERT INTO price_history(nmid, ts, basic_u, product_u) VALUES(?,?,?,?)"
+            )
+            await self._write(sql, rows, many=True)
+        return len(rows)
 
-        await self.db.execute(
-            "INSERT INTO price_history(nmid, ts, basic_u, product_u) VALUES(?,?,?,?)",
-            (int(nmid), ts_i, basic_u, product_u),
+    async def _seed_last_prices(self, nmids: List[int]) -> None:
+        marks = ",".join("?" * len(nmids))
+        cur = await self.rdb.execute(
+            f"SELECT nmid, basic_u, product_u FROM price_history p WHERE nmid IN ({marks}) "
+            "AND ts = (SELECT MAX(ts) FROM price_history WHERE nmid = p.nmid)",
+            nmids,
         )
-        await self.db.commit()
+        for nmid, basic_u, product_u in await cur.fetchall():
+            self._last_price.setdefault(int(nmid), (basic_u, product_u))
+        await cur.close()
 
     async def price_get_history(self, nmid: int, limit: int = 12) -> List[Dict[str, Optional[int]]]:
-        cur = await self.db.execute(
+        cur = await self.rdb.execute(
             "SELECT ts, basic_u, product_u FROM price_history WHERE nmid=? ORDER BY ts DESC LIMIT ?",
             (int(nmid), int(limit)),
         )
         rows = await cur.fetchall()
         await cur.close()
         return [{"ts": int(ts), "basic_u": basic_u, "product_u": product_u} for (ts, basic_u, product_u) in rows]
+
+    # --- job queue ---
+    async def job_put(self, user_id: int, chat_id: int, payload: Dict[str, Any]) -> int:
+        """Persist a new queued job; returns its id."""
+        self._job_seq += 1
+        job_id = self._job_seq * self.process_count + self.process_index
+        await self._write(
+            "INSERT INTO jobs(id, user_id, chat_id, payload_json, created_at) VALUES(?,?,?,?,?)",
+            (job_id, int(user_id), int(chat_id), json.dumps(payload, ensure_ascii=False), int(time.time())),
+        )
+        return job_id
+
+    async def job_start(self, job_id: int) -> None:
+        await self._write("UPDATE jobs SET status='running', attempts=attempts+1 WHERE id=?", (int(job_id),))
+
+    async def job_done(self, job_id: int) -> None:
+        await self._write("DELETE FROM jobs WHERE id=?", (int(job_id),), wait=False)
+
+    async def job_claim(self, job_id: int, user_id: int) -> Optional[bool]:
+        """job_start() for a database shared by several processes: the job starts
+        only if no job of the same user is running anywhere, counting only runs
+        started within JOB_LEASE_SECONDS. True if started, False if it has to
+        wait, None if the job is gone (replaced elsewhere)."""
+        now = int(time.time())
+        rows = await self._write(
+            "UPDATE jobs SET status='running', attempts=attempts+1, owner_pid=?, started_at=? "
+            "WHERE id=? AND status='queued' AND NOT EXISTS "
+            "(SELECT 1 FROM jobs WHERE user_id=? AND status='running' AND started_at > ?) RETURNING id",
+            (os.getpid(), now, int(job_id), int(user_id), now - JOB_LEASE_SECONDS),
+            fetch=True,
+        )
+        if rows:
+            return True
+        cur = await self.rdb.execute("SELECT 1 FROM jobs WHERE id=? AND status='queued'", (int(job_id),))
+        row = await cur.fetchone()
+        await cur.close()
+        return False if row else None
+
+    async def job_drop_queued(self, user_id: int, keep: int) -> List[Tuple[int, int, Dict[str, Any]]]:
+        """Delete the user's queued jobs other than `keep`, whichever process queued
+        them; returns their (id, chat_id, payload)."""
+        rows = await self._write(
+            "DELETE FROM jobs WHERE user_id=? AND status='queued' AND id<>? RETURNING id, chat_id, payload_json",
+            (int(user_id), int(keep)),
+            fetch=True,
+        )
+        return [(int(i), int(c), json.loads(p)) for (i, c, p) in rows or []]
+
+    async def job_requeue_interrupted(self) -> int:
+        """Mark jobs left running by a previous run as queued; returns how many."""
+        rows = await self._write("UPDATE jobs SET status='queued' WHERE status='running' RETURNING id", fetch=True)
+        return len(rows or [])
+
+    async def job_list(self, queued_only: bool = False) -> List[Tuple[int, int, int, Dict[str, Any], int]]:
+        """(id, user_id, chat_id, payload, attempts) of every unfinished (or only
+        every queued) job, oldest first."""
+        where = " WHERE status='queued'" if queued_only else ""
+        cur = await self.rdb.execute(f"SELECT id, user_id, chat_id, payload_json, attempts FROM jobs{where} ORDER BY id")
+        rows = await cur.fetchall()
+        await cur.close()
+        return [(int(i), int(u), int(c), json.loads(p), int(a)) for (i, u, c, p, a) in rows]
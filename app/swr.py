@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import random
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .singleflight import SingleFlight
+from .storage import Storage
+
+# loader(previous value or None) -> new value; the loader persists what it returns
+Loader = Callable[[Optional[Any]], Awaitable[Any]]
+
+
+class SWRCache:
+    """Stale-while-revalidate + probabilistic early refresh over Storage's cache table.
+
+    - fresh entry: returned as is, but with XFetch probability
+      (now + delta * beta * -ln(U) >= expires_at, delta = last load time)
+      a single background refresh is started before expiry;
+    - expired for at most `max_stale_seconds`: returned immediately while one
+      background refresh runs;
+    - missing or older: the caller waits for a (coalesced) load.
+    """
+
+    DEFAULT_DELTA_S = 1.0
+    MAX_DELTAS = 10_000
+
+    def __init__(self, flights: SingleFlight):
+        self._flights = flights
+        # last load time per key, most recently loaded last; cold keys fall back to the default
+        self._deltas: "OrderedDict[str, float]" = OrderedDict()
+        self._background: Dict[str, "asyncio.Future[Any]"] = {}
+
+    async def get(
+        self,
+        storage: Storage,
+        key: str,
+        loader: Loader,
+        max_stale_seconds: int = 0,
+        beta: float = 1.0,
+    ) -> Any:
+        value, _ = await self.get_fresh(storage, key, loader, max_stale_seconds, beta)
+        return value
+
+    async def get_fresh(
+        self,
+        storage: Storage,
+        key: str,
+        loader: Loader,
+        max_stale_seconds: int = 0,
+        beta: float = 1.0,
+    ) -> Tuple[Any, bool]:
+        """Like get(), plus whether the value is within its TTL (False: served stale)."""
+        entry = await storage.cache_get_stale(key)
+        if entry is None:
+            return await self._load(key, loader, None), True
+
+        value, expires_at = entry
+        now = time.time()
+        if now > expires_at:
+            if now - expires_at > max_stale_seconds:
+                return await self._load(key, loader, value), True
+            self._refresh_in_background(key, loader, value)
+            return value, False
+
+        if beta > 0:
+            delta = self._deltas.get(key, self.DEFAULT_DELTA_S)
+            if now - delta * beta * math.log(1.0 - random.random()) >= expires_at:
+                self._refresh_in_background(key, loader, value)
+        return value, True
+
+    async def _load(self, key: str, loader: Loader, previous: Optional[Any]) -> Any:
+        async def run() -> Any:
+            started = time.monotonic()
+            value = await loader(previous)
+            self._deltas[key] = time.monotonic() - started
+            self._deltas.move_to_end(key)
+            if len(self._deltas) > self.MAX_DELTAS:
+                self._deltas.popitem(last=False)
+            return value
+
+        return await self._flights.do(f"swr:{key}", run)
+
+    def _refresh_in_background(self, key: str, loader: Loader, previous: Any) -> None:
+        if key in self._background:
+            return
+        task = asyncio.ensure_future(self._load(key, loader, previous))
+        self._background[key] = task
+        task.add_done_callback(lambda t, k=key: self._background_done(k, t))
+
+    async def wait_refresh(self, key: str) -> None:
+        """Wait for a background refresh of `key` in progress, if any; its errors are ignored."""
+        task = self._background.get(key)
+        if task is not None:
+            await asyncio.wait({task})
+
+    def refresh_many(self, keys: List[str], loader: Callable[[List[str]], Awaitable[Dict[str, Any]]]) -> None:
+        """One background refresh (e.g. a bulk request) for those of `keys` not
+        already being loaded, here or by get(). The loader persists its values and
+        returns them by key. Each key joins its `swr:{key}` flight, so a get() of
+        one of them waits for this refresh instead of starting another; a key
+        missing from the loader's result fails that flight."""
+        todo = [
+            k for k in dict.fromkeys(keys) if k not in self._background and not self._flights.running(f"swr:{k}")
+        ]
+        if not todo:
+            return
+        bulk = asyncio.ensure_future(loader(todo))
+
+        async def value_of(key: str) -> Any:
+            values = await bulk
+            if key not in values:
+                raise LookupError(f"{key}: not returned by the bulk refresh")
+            return values[key]
+
+        for key in todo:
+            task = self._flights.start(f"swr:{key}", lambda k=key: value_of(k))
+            self._background[key] = task
+            task.add_done_callback(lambda t, k=key: self._background_done(k, t))
+
+    def _background_done(self, key: str, task: "asyncio.Future[Any]") -> None:
+        if self._background.get(key) is task:
+            del self._background[key]
+        if not task.cancelled():
+            task.exception()  # a failed refresh keeps serving the stale value
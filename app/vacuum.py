@@ -0,0 +1,37 @@
+"""One-off switch of an existing database to incremental auto-vacuum.
+
+    python -m app.vacuum [path/to/bot.sqlite3]
+
+The cache sweeper returns freed pages to the OS in small steps (PRAGMA
+incremental_vacuum), which works only in auto_vacuum=INCREMENTAL mode. New
+databases get it at creation; a file created before that needs one full VACUUM
+to switch. VACUUM rewrites the whole file under an exclusive lock and needs as
+much free disk space again, so stop the bot while it runs.
+"""
+from __future__ import annotations
+
+import sqlite3
+import sys
+import time
+
+from .config import Settings
+
+
+def main() -> None:
+    path = sys.argv[1] if len(sys.argv) > 1 else Settings(bot_token="").sqlite_path
+    db = sqlite3.connect(path, isolation_level=None)
+    try:
+        (mode,) = db.execute("PRAGMA auto_vacuum").fetchone()
+        if int(mode) == 2:
+            print(f"{path}: already incremental")
+            return
+        started = time.perf_counter()
+        db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        db.execute("VACUUM")
+        print(f"{path}: switched to incremental auto-vacuum in {time.perf_counter() - started:.1f}s")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,23 @@
 from __future__ import annotations
 
+import asyncio
 import re
-from typing import Any, Dict, List, Optional, Tuple
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import httpx
 
+from .codec import RawJSON
+
 NMID_RE = re.compile(r"(?:/catalog/|nm=)(\d{6,12})")
+# a bare article number: a standalone run of digits, not part of a URL or another token;
+# a sentence may end right after it. Phone numbers (11 digits from 7/8) and amounts
+# followed by a currency are not article numbers.
+BARE_NMID_RE = re.compile(
+    r"(?<![\w/=.+-])(?![78]\d{10}(?!\d))(\d{6,12})(?![\w/-]|\.\S)(?!\s*(?:руб|р\b|₽))",
+    re.IGNORECASE,
+)
 
 def extract_nmid(text: str) -> Optional[int]:
     text = text.strip()
@@ -16,6 +28,135 @@ def extract_nmid(text: str) -> Optional[int]:
         return None
     return int(m.group(1))
 
+def extract_nmids(text: str, limit: int = 0) -> List[int]:
+    """Every nmId in a message (links and bare article numbers), in order of
+    appearance, without repeats; at most `limit` of them (0 = all)."""
+    text = text.strip()
+    if text.isdigit():
+        return [int(text)]
+    found = [(m.start(), int(m.group(1))) for m in NMID_RE.finditer(text)]
+    found += [(m.start(), int(m.group(1))) for m in BARE_NMID_RE.finditer(text)]
+    out = list(dict.fromkeys(nmid for _, nmid in sorted(found)))
+    return out[:limit] if limit > 0 else out
+
+# where the feedback list lives in the (unstable) response shapes, in lookup order
+_FEEDBACK_LIST_PATHS = (
+    ("feedbacks",),
+    ("data", "feedbacks"),
+    ("feedbacksWithText",),
+    ("data", "feedbacksWithText"),
+)
+
+
+def _feedback_items(data: Dict[str, Any]) -> Optional[List[Any]]:
+    for path in _FEEDBACK_LIST_PATHS:
+        node: Any = data
+        for k in path:
+            node = node.get(k) if isinstance(node, dict) else None
+        if isinstance(node, list):
+            return node
+    return None
+
+
+def _item_id(item: Any) -> Any:
+    return item.get("id") if isinstance(item, dict) else None
+
+
+def _with_feedback_items(data: Dict[str, Any], items: List[Any]) -> Dict[str, Any]:
+    for path in _FEEDBACK_LIST_PATHS:
+        node: Any = data
+        for k in path:
+            node = node.get(k) if isinstance(node, dict) else None
+        if isinstance(node, list):
+            if len(path) == 1:
+                return {**data, path[0]: items}
+            return {**data, path[0]: {**data[path[0]], path[1]: items}}
+    return data
+
+
+@dataclass
+class FeedbackPage:
+    data: Dict[str, Any]
+    host: str
+    variant: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class FeedbackHealth:
+    """Scored (host, variant) table for the feedback endpoint.
+
+    Keeps a success-rate and latency EWMA per pair; pairs failing repeatedly go
+    into exponential cooldown. dump()/load() give a JSON-able form for persistence.
+    """
+
+    ALPHA = 0.2
+    PRIOR_LATENCY_S = 1.0
+    COOLDOWN_AFTER_FAILS = 2
+    COOLDOWN_BASE_S = 30.0
+    COOLDOWN_MAX_S = 3600.0
+
+    def __init__(self) -> None:
+        # "host variant" -> {"ok", "lat", "fails", "cooldown_until"}
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    @staticmethod
+    def _key(host: str, variant: str) -> str:
+        return f"{host} {variant}"
+
+    def _get(self, host: str, variant: str) -> Dict[str, float]:
+        return self._stats.setdefault(
+            self._key(host, variant),
+            {"ok": 0.5, "lat": self.PRIOR_LATENCY_S, "fails": 0, "cooldown_until": 0.0},
+        )
+
+    def record_success(self, host: str, variant: str, latency_s: float) -> None:
+        st = self._get(host, variant)
+        st["ok"] = st["ok"] * (1 - self.ALPHA) + self.ALPHA
+        st["lat"] = st["lat"] * (1 - self.ALPHA) + latency_s * self.ALPHA
+        st["fails"] = 0
+        st["cooldown_until"] = 0.0
+
+    def record_failure(self, host: str, variant: str) -> None:
+        st = self._get(host, variant)
+        st["ok"] = st["ok"] * (1 - self.ALPHA)
+        st["fails"] += 1
+        if st["fails"] >= self.COOLDOWN_AFTER_FAILS:
+            backoff = self.COOLDOWN_BASE_S * 2 ** (st["fails"] - self.COOLDOWN_AFTER_FAILS)
+            st["cooldown_until"] = time.time() + min(self.COOLDOWN_MAX_S, backoff)
+
+    def rank(self, pairs: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """Best expected cost (latency / success rate) first; cooling-down pairs
+        only if nothing else is left. Ties keep the given order."""
+        now = time.time()
+
+        def cost(pair: Tuple[str, str]) -> float:
+            st = self._stats.get(self._key(*pair))
+            if st is None:
+                return self.PRIOR_LATENCY_S / 0.5
+            return st["lat"] / max(st["ok"], 0.05)
+
+        live = [p for p in pairs if self._stats.get(self._key(*p), {}).get("cooldown_until", 0.0) <= now]
+        if not live:
+            return sorted(pairs, key=lambda p: self._stats[self._key(*p)]["cooldown_until"])
+        return sorted(live, key=cost)
+
+    def dump(self) -> Dict[str, Dict[str, float]]:
+        return {k: dict(v) for k, v in self._stats.items()}
+
+    def load(self, data: Dict[str, Dict[str, float]]) -> None:
+        for k, v in (data or {}).items():
+            try:
+                self._stats[k] = {
+                    "ok": float(v["ok"]),
+                    "lat": float(v["lat"]),
+                    "fails": int(v.get("fails", 0)),
+                    "cooldown_until": float(v.get("cooldown_until", 0.0)),
+                }
+            except (KeyError, TypeError, ValueError):
+                continue
+
+
 class WBClient:
     # Неофициальный публичный эндпойнт карточки товара (может меняться)
     CARD_URL = "https://card.wb.ru/cards/v4/detail"
@@ -25,10 +166,15 @@ class WBClient:
         "https://feedbacks1.wb.ru",
         "https://feedbacks2.wb.ru",
     ]
+    # query-parameter styles the feedback endpoint has accepted at various times
+    FEEDBACK_VARIANTS = ("take_skip", "limit_offset", "plain")
 
-    def __init__(self, dest: str, locale: str = "ru", timeout_s: float = 12.0):
+    def __init__(self, dest: str, locale: str = "ru", timeout_s: float = 12.0, hedge_delay_s: float = 1.5):
         self.dest = dest
         self.locale = locale
+        # start the next feedback candidate if the current ones are slower than this (~p95)
+        self.hedge_delay_s = hedge_delay_s
+        self.feedback_health = FeedbackHealth()
         self.client = httpx.AsyncClient(
             timeout=timeout_s,
             headers={
@@ -40,38 +186,235 @@ class WBClient:
     async def aclose(self) -> None:
         await self.client.aclose()
 
-    async def get_product(self, nmid: int) -> Dict[str, Any]:
+    async def get_product_raw(self, nmid: int) -> RawJSON:
+        """Card response body as received, for caching without a re-encode;
+        see first_product() for the card itself."""
         params = {"dest": self.dest, "locale": self.locale, "nm": str(nmid)}
         r = await self.client.get(self.CARD_URL, params=params)
         r.raise_for_status()
-        data = r.json()
+        return RawJSON(r.content)
+
+    async def get_product(self, nmid: int) -> Dict[str, Any]:
+        return self.first_product(await (await self.get_product_raw(nmid)).parse())
+
+    @staticmethod
+    def first_product(data: Dict[str, Any]) -> Dict[str, Any]:
         products = data.get("products") or data.get("data", {}).get("products") or []
         if not products:
             raise ValueError("WB: product not found")
         return products[0]
 
-    async def get_feedbacks(self, root_id: int, limit: int = 120) -> Dict[str, Any]:
-        candidates: List[Tuple[str, Dict[str, str]]] = [
-            (f"/feedbacks/v1/{root_id}", {"take": str(limit), "skip": "0"}),
-            (f"/feedbacks/v1/{root_id}", {"limit": str(limit), "offset": "0"}),
-            (f"/feedbacks/v1/{root_id}", {}),
-        ]
-
-        last_exc: Optional[Exception] = None
-        for host in self.FEEDBACK_HOSTS:
-            for path, params in candidates:
-                url = host + path
+    async def get_products(self, nmids: List[int], chunk_size: int = 50) -> Dict[int, Dict[str, Any]]:
+        """Bulk card fetch: `nm` takes a `;`-separated list, so ids go out in chunks
+        (concurrently) and products are mapped back by their `id`. Ids WB does not
+        return are simply absent from the result."""
+        ids = list(dict.fromkeys(int(x) for x in nmids))
+
+        async def fetch_chunk(chunk: List[int]) -> List[Dict[str, Any]]:
+            params = {"dest": self.dest, "locale": self.locale, "nm": ";".join(str(x) for x in chunk)}
+            r = await self.client.get(self.CARD_URL, params=params)
+            r.raise_for_status()
+            data = await RawJSON(r.content).parse()
+            return data.get("products") or data.get("data", {}).get("products") or []
+
+        chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+        wanted = set(ids)
+        out: Dict[int, Dict[str, Any]] = {}
+        for products in await asyncio.gather(*(fetch_chunk(c) for c in chunks)):
+            for p in products:
                 try:
-                    r = await self.client.get(url, params=params)
-                    if r.status_code != 200:
-                        continue
-                    return r.json()
-                except Exception as e:
-                    last_exc = e
+                    pid = int(p.get("id"))
+                except (TypeError, ValueError):
+                    continue
+                if pid in wanted:
+                    out[pid] = p
+        return out
+
+    @staticmethod
+    def _feedback_params(variant: str, limit: int, skip: int = 0) -> Dict[str, str]:
+        if variant == "take_skip":
+            return {"take": str(limit), "skip": str(skip)}
+        if variant == "limit_offset":
+            return {"limit": str(limit), "offset": str(skip)}
+        return {}
+
+    async def _get_feedbacks_once(
+        self, host: str, variant: str, root_id: int, limit: int, skip: int = 0
+    ) -> FeedbackPage:
+        url = f"{host}/feedbacks/v1/{root_id}"
+        started = time.monotonic()
+        try:
+            r = await self.client.get(url, params=self._feedback_params(variant, limit, skip))
+            if r.status_code != 200:
+                raise RuntimeError(f"HTTP {r.status_code} from {url}")
+            data = await RawJSON(r.content).parse()
+        except asyncio.CancelledError:
+            raise  # lost a hedge race: says nothing about the pair
+        except Exception:
+            self.feedback_health.record_failure(host, variant)
+            raise
+        self.feedback_health.record_success(host, variant, time.monotonic() - started)
+        return FeedbackPage(
+            data=data,
+            host=host,
+            variant=variant,
+            etag=r.headers.get("etag"),
+            last_modified=r.headers.get("last-modified"),
+        )
+
+    async def get_feedbacks(self, root_id: int, limit: int = 120, skip: int = 0) -> Dict[str, Any]:
+        return (await self._get_feedbacks_hedged(root_id, limit, skip)).data
+
+    async def _get_feedbacks_hedged(self, root_id: int, limit: int, skip: int) -> FeedbackPage:
+        """Hedged fetch: start the preferred candidate, add the next one every
+        `hedge_delay_s` (or right away when one fails), return the first valid
+        200 response and cancel the rest."""
+        # alternate hosts first: a hedge should not wait on the same slow host;
+        # then the health table moves known-good pairs up and dead ones out
+        pairs = [(host, variant) for variant in self.FEEDBACK_VARIANTS for host in self.FEEDBACK_HOSTS]
+        queue = iter(self.feedback_health.rank(pairs))
+        pending: Dict[asyncio.Task[FeedbackPage], Tuple[str, str]] = {}
+
+        def launch() -> bool:
+            nxt = next(queue, None)
+            if nxt is None:
+                return False
+            host, variant = nxt
+            pending[asyncio.create_task(self._get_feedbacks_once(host, variant, root_id, limit, skip))] = nxt
+            return True
+
+        last_exc: Optional[BaseException] = None
+        more = launch()
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=self.hedge_delay_s if more else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    more = launch()  # hedge: the current attempts are slow
                     continue
+                for t in done:
+                    pending.pop(t)
+                    exc = t.exception()
+                    if exc is None:
+                        return t.result()
+                    last_exc = exc
+                    more = launch()
+        finally:
+            for t in pending:
+                t.cancel()
 
         raise RuntimeError(f"WB: cannot fetch feedbacks for root={root_id}: {last_exc}")
 
+    async def get_feedbacks_paged(
+        self,
+        root_id: int,
+        page_size: int = 120,
+        max_items: int = 1000,
+        concurrency: int = 4,
+        meta: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """Fetch up to `max_items` feedbacks as `skip` pages, `concurrency` at a time.
+
+        Page 0 goes through the hedged path and picks the (host, variant) for the
+        rest. Pages are merged in order; the first short page ends the fetch and
+        cancels the pages still in flight behind it. A page that starts with a
+        review already seen means the pair ignored `skip`: it counts as a failure
+        of that pair, and merging stops before such a page. If `meta` is given, it gets
+        page 0's host, variant and validators for feedbacks_not_modified().
+        """
+        page0 = await self._get_feedbacks_hedged(root_id, page_size, 0)
+        first, host, variant = page0.data, page0.host, page0.variant
+        if meta is not None:
+            meta.update(host=host, variant=variant, etag=page0.etag, last_modified=page0.last_modified)
+        items = _feedback_items(first)
+        if variant == "plain" or items is None or len(items) != page_size or page_size >= max_items:
+            # unpaged response (more than a page: the host ignored the limit),
+            # or everything fits in one page
+            return first
+
+        # a failed page is retried with the same variant on the other hosts only:
+        # another variant may ignore `skip` and return page 0 again
+        page_hosts = [host] + [h for h in self.FEEDBACK_HOSTS if h != host]
+        first_ids = {_item_id(x) for x in items} - {None}
+
+        async def fetch_page(skip: int) -> List[Any]:
+            for h in page_hosts:
+                try:
+                    data = (await self._get_feedbacks_once(h, variant, root_id, page_size, skip)).data
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    continue
+                page = _feedback_items(data) or []
+                if page and _item_id(page[0]) in first_ids:
+                    self.feedback_health.record_failure(h, variant)  # page 0 again: `skip` ignored
+                    continue
+                return page
+            return []  # a lost page ends the fetch: analyze what we have
+
+        pages: Dict[int, List[Any]] = {0: items}
+        offsets = iter(range(page_size, max_items, page_size))
+        stop_at = max_items  # first offset known to be past the end
+        running: Dict[asyncio.Task[List[Any]], int] = {}
+
+        def launch() -> None:
+            skip = next(offsets, None)
+            if skip is not None and skip < stop_at:
+                running[asyncio.create_task(fetch_page(skip))] = skip
+
+        try:
+            for _ in range(max(1, concurrency)):
+                launch()
+            while running:
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    skip = running.pop(t, None)
+                    if skip is None:
+                        continue  # dropped by a short page earlier in this batch
+                    page = t.result()
+                    pages[skip] = page
+                    if len(page) < page_size:
+                        stop_at = min(stop_at, skip + page_size)
+                        for other, other_skip in list(running.items()):
+                            if other_skip >= stop_at:
+                                other.cancel()
+                                running.pop(other)
+                    launch()
+        finally:
+            for t in running:
+                t.cancel()
+
+        merged: List[Any] = []
+        seen: Set[Any] = set()
+        for skip in sorted(pages):
+            page = pages[skip]
+            if skip >= stop_at or (page and _item_id(page[0]) in seen):
+                break  # past the end, or a repeated page (an offset was not honored)
+            seen.update(_item_id(x) for x in page)
+            seen.discard(None)
+            merged.extend(page)
+        return _with_feedback_items(first, merged[:max_items])
+
+    async def feedbacks_not_modified(self, root_id: int, limit: int, meta: Dict[str, Any]) -> bool:
+        """Conditional GET of page 0 with the validators saved by get_feedbacks_paged.
+        True only on an explicit 304; anything else means "refetch"."""
+        headers: Dict[str, str] = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = str(meta["etag"])
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = str(meta["last_modified"])
+        if not headers or not meta.get("host"):
+            return False
+        url = f"{meta['host']}/feedbacks/v1/{root_id}"
+        try:
+            r = await self.client.get(url, params=self._feedback_params(str(meta.get("variant")), limit), headers=headers)
+        except Exception:
+            return False
+        return r.status_code == 304
+
     @staticmethod
     def parse_price(product: Dict[str, Any]) -> Tuple[Optional[int], Optional[int]]:
         sizes = product.get("sizes") or []
@@ -83,6 +426,14 @@ class WBClient:
                 return int(basic), int(product_price)
         return None, None
 
+    @staticmethod
+    def feedback_count(product: Dict[str, Any]) -> Optional[int]:
+        for k in ("feedbacks", "nmFeedbacks"):
+            v = product.get(k)
+            if isinstance(v, int):
+                return v
+        return None
+
     @staticmethod
     def total_stock(product: Dict[str, Any]) -> Optional[int]:
         tq = product.get("totalQuantity")
@@ -0,0 +1,60 @@
+import random
+import time
+import unittest
+from datetime import datetime
+
+from app.analyzer import Review, decode_reviews, encode_reviews, near_duplicates, shingles
+
+
+class NearDuplicatesTest(unittest.TestCase):
+    def test_clusters_near_and_identical_sets(self):
+        a = "очень хороший товар пришел быстро качество отличное рекомендую всем".split()
+        b = list(a)
+        b[-1] = "друзьям"
+        c = "ужасный размер маломерит ткань тонкая вернула обратно продавцу сразу".split()
+        pairs, cluster = near_duplicates([shingles(a), shingles(a), shingles(a + ["да"]), shingles(c), set()])
+        self.assertEqual(cluster[0], cluster[1])
+        self.assertEqual(cluster[0], cluster[2])
+        self.assertNotEqual(cluster[0], cluster[3])
+        self.assertNotEqual(cluster[0], cluster[4])
+        self.assertEqual(pairs, 3)
+
+    def test_template_spam_stays_linear(self):
+        # every review lands in the same LSH buckets: used to be a quadratic pair check
+        rng = random.Random(7)
+        words = [f"w{i}" for i in range(500)]
+        template = [rng.choice(words) for _ in range(40)]
+        sh = []
+        for _ in range(4000):
+            t = list(template)
+            t[rng.randrange(len(t))] = rng.choice(words)
+            sh.append(shingles(t))
+
+        started = time.perf_counter()
+        pairs, cluster = near_duplicates(sh)
+        elapsed = time.perf_counter() - started
+
+        self.assertLess(elapsed, 10.0)
+        biggest = max(cluster.count(c) for c in set(cluster))
+        self.assertGreater(biggest, 2000)
+        self.assertGreaterEqual(pairs, biggest * (biggest - 1) // 2)
+
+
+class ReviewEncodingTest(unittest.TestCase):
+    def test_round_trip(self):
+        reviews = [
+            Review(rating=5, text="Отличное платье, размер в размер 👍", created=datetime(2024, 3, 1, 12, 30, 5)),
+            Review(rating=None, text="без оценки", created=datetime(1969, 12, 31, 23, 59, 59)),
+            Review(rating=1, text="", created=None),
+            Review(rating=None, text="ни оценки, ни даты", created=None),
+        ]
+        self.assertEqual(decode_reviews(encode_reviews(reviews)), reviews)
+
+    def test_empty_and_foreign_blobs(self):
+        self.assertEqual(decode_reviews(encode_reviews([])), [])
+        with self.assertRaises(ValueError):
+            decode_reviews(b'{"feedbacks": []}')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+from app import codec
+
+
+class CompressValueTest(unittest.TestCase):
+    def setUp(self):
+        self.samples = [
+            f'{{"id": {n}, "brand": "Бренд {n % 7}", "name": "Платье женское летнее", "sizes": []}}'
+            for n in range(100)
+        ]
+        self.zdict = codec.train_zdict(self.samples)
+
+    def test_round_trip_with_dictionary(self):
+        self.assertTrue(self.zdict)
+        text = self.samples[3]
+        blob = codec.compress_value(text, 2, self.zdict)
+        self.assertTrue(codec.is_compressed(blob))
+        self.assertEqual(codec.decompress_value(blob, {2: self.zdict}), text)
+        self.assertLess(len(blob), len(codec.compress_value(text)))
+
+    def test_bytes_stay_bytes(self):
+        self.assertEqual(codec.decompress_value(codec.compress_value(b"\x00\x01bin"), {}), b"\x00\x01bin")
+        self.assertFalse(codec.is_compressed(b"\x00\x01bin"))
+        self.assertFalse(codec.is_compressed(self.samples[0]))
+
+    def test_json_bytes_come_back_as_raw_json(self):
+        body = self.samples[0].encode("utf-8")
+        for level in (0, 6):
+            with self.subTest(level=level):
+                raw = codec.decompress_value(codec.compress_value(codec.RawJSON(body), level=level), {})
+                self.assertIsInstance(raw, codec.RawJSON)
+                self.assertEqual(raw.raw, body)
+                self.assertEqual(raw.value["brand"], "Бренд 0")
+
+    def test_raw_json_of_keeps_the_parsed_value(self):
+        value = {"products": [{"id": 1, "name": "Я"}]}
+        doc = codec.RawJSON.of(value)
+        self.assertIs(doc.value, value)
+        self.assertEqual(codec.RawJSON(doc.raw).value, value)
+
+    def test_unknown_dictionary(self):
+        blob = codec.compress_value(self.samples[0], 5, self.zdict)
+        with self.assertRaises(ValueError):
+            codec.decompress_value(blob, {})
+        with self.assertRaises(ValueError):
+            codec.decompress_value(blob, {5: b"another dictionary"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from app import jobs as jobs_module
+from app.jobs import JobQueue
+from app.storage import Storage
+
+
+async def _until(cond, timeout: float = 5.0) -> None:
+    """Poll `cond` (plain or async) until it holds."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    async def check() -> bool:
+        result = cond()
+        return await result if asyncio.iscoroutine(result) else result
+
+    while not await check():
+        if loop.time() > deadline:
+            raise AssertionError("condition not reached")
+        await asyncio.sleep(0.01)
+
+
+class JobQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "bot.sqlite3")
+        self.storage = await self._connect()
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+        self.tmp.cleanup()
+
+    async def _connect(self) -> Storage:
+        storage = Storage(self.path, compress=False, sweep_seconds=0)
+        await storage.connect()
+        return storage
+
+    async def _payloads(self, expected, queued_only: bool = False) -> bool:
+        """Persisted jobs' payloads are `expected`."""
+        return [payload for _, _, _, payload, _ in await self.storage.job_list(queued_only)] == expected
+
+    async def test_new_request_replaces_queued_job(self):
+        gate = asyncio.Event()
+        ran, replaced = [], []
+
+        async def handler(job):
+            ran.append(job.payload["n"])
+            await gate.wait()
+
+        async def on_replaced(job):
+            replaced.append(job.payload["n"])
+
+        jobs = JobQueue(self.storage, workers=2)
+        await jobs.start(handler, recover=False, on_replaced=on_replaced)
+        try:
+            await jobs.submit(1, 10, {"n": 1})
+            await _until(lambda: ran == [1])
+            # the user's first job runs: the next one waits, and a newer one replaces it
+            self.assertEqual(await jobs.submit(1, 10, {"n": 2}), 1)
+            self.assertEqual(await jobs.submit(1, 10, {"n": 3}), 1)
+            self.assertEqual(len(jobs), 1)
+            await _until(lambda: replaced == [2])
+            await _until(lambda: self._payloads(queued_only=True, expected=[{"n": 3}]))
+
+            gate.set()
+            await _until(lambda: ran == [1, 3])
+            await _until(lambda: self._payloads(expected=[]))
+        finally:
+            await jobs.close()
+
+    async def test_queued_job_survives_restart(self):
+        gate = asyncio.Event()
+        ran = []
+
+        async def handler(job):
+            ran.append(job.payload["n"])
+            await gate.wait()
+
+        jobs = JobQueue(self.storage, workers=1)
+        await jobs.start(handler, recover=False)
+        await jobs.submit(1, 10, {"n": 1})
+        await _until(lambda: ran == [1])
+        await jobs.submit(2, 20, {"n": 2})  # no free worker: stays queued
+        await jobs.close()
+        await self.storage.close()
+
+        # the interrupted job and the queued one both run again, each once
+        self.storage = await self._connect()
+        await self.storage.job_requeue_interrupted()
+        ran.clear()
+        gate.set()
+        jobs = JobQueue(self.storage, workers=1)
+        await jobs.start(handler)
+        try:
+            await _until(lambda: sorted(ran) == [1, 2])
+            await _until(lambda: self._payloads(expected=[]))
+        finally:
+            await jobs.close()
+
+    async def test_job_that_fails_to_start_is_kept_and_retried(self):
+        ran = []
+        job_start = self.storage.job_start
+        failures = [sqlite3.OperationalError("database is locked")]
+
+        async def flaky_job_start(job_id):
+            if failures:
+                raise failures.pop()
+            await job_start(job_id)
+
+        async def handler(job):
+            ran.append(job.payload["n"])
+
+        jobs = JobQueue(self.storage, workers=1)
+        with mock.patch.object(self.storage, "job_start", flaky_job_start), \
+                mock.patch.object(jobs_module, "START_RETRY_SECONDS", 0.2), \
+                self.assertLogs("app.jobs", "ERROR"):
+            await jobs.start(handler, recover=False)
+            try:
+                await jobs.submit(1, 10, {"n": 1})
+                await _until(lambda: not failures)
+                self.assertEqual(ran, [])
+                self.assertEqual(len(jobs), 1)
+                await _until(lambda: self._payloads(queued_only=True, expected=[{"n": 1}]))
+
+                await _until(lambda: ran == [1])
+                await _until(lambda: self._payloads(expected=[]))
+            finally:
+                await jobs.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+from app.lru import MemoryLRU
+
+
+class MemoryLRUTest(unittest.TestCase):
+    def test_evicts_least_recently_used_by_size(self):
+        lru = MemoryLRU(max_bytes=10)
+        lru.set("a", 1, size=4, expires_at=100)
+        lru.set("b", 2, size=4, expires_at=100)
+        self.assertEqual(lru.get("a", now=0), 1)  # "b" is now the oldest
+        lru.set("c", 3, size=4, expires_at=100)
+        self.assertIsNone(lru.get("b", now=0))
+        self.assertEqual(lru.get("a", now=0), 1)
+        self.assertEqual(lru.get("c", now=0), 3)
+        self.assertEqual(lru.bytes, 8)
+        self.assertEqual(lru.evictions, 1)
+
+    def test_expiry_touch_and_replace(self):
+        lru = MemoryLRU(max_bytes=100)
+        lru.set("a", 1, size=10, expires_at=5)
+        self.assertEqual(lru.get_entry("a", now=5), (1, 5))
+        lru.touch("a", expires_at=20)
+        self.assertEqual(lru.get("a", now=10), 1)
+        self.assertIsNone(lru.get("a", now=21))
+        self.assertEqual((len(lru), lru.bytes), (0, 0))
+
+        lru.set("b", 1, size=10, expires_at=50)
+        lru.set("b", 2, size=30, expires_at=50)
+        self.assertEqual((lru.get("b", now=0), lru.bytes), (2, 30))
+
+    def test_oversized_value_is_not_cached(self):
+        lru = MemoryLRU(max_bytes=10)
+        lru.set("a", 1, size=4, expires_at=100)
+        lru.set("big", 2, size=11, expires_at=100)
+        self.assertIsNone(lru.get("big", now=0))
+        self.assertEqual(lru.get("a", now=0), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
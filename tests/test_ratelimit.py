@@ -0,0 +1,38 @@
+import unittest
+
+from app.ratelimit import RateLimiter
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_burst_then_continuous_refill(self):
+        rl = RateLimiter(capacity=3, window_seconds=60)
+        self.assertEqual([rl.allow(1, now=0) for _ in range(4)], [True, True, True, False])
+        self.assertTrue(rl.allow(2, now=0))  # buckets are per key
+        self.assertFalse(rl.allow(1, now=19))
+        self.assertTrue(rl.allow(1, now=20))  # one token per 20 s
+        self.assertFalse(rl.allow(1, now=20))
+
+    def test_idle_buckets_are_evicted(self):
+        rl = RateLimiter(capacity=2, window_seconds=60)
+        rl.allow(1, now=0)
+        rl.allow(2, now=30)
+        self.assertEqual(rl.evict_idle(now=60), 1)
+        self.assertEqual(len(rl), 1)
+
+    def test_snapshot_and_restore(self):
+        rl = RateLimiter(capacity=2, window_seconds=60)
+        rl.allow(1, now=0)
+        rl.allow(1, now=0)
+        rl.allow(2, now=0)
+        rows = sorted(rl.take_dirty())
+        self.assertEqual(rows, [(1, 0.0, 0), (2, 1.0, 0)])
+        self.assertEqual(rl.take_dirty(), [])
+
+        restored = RateLimiter(capacity=2, window_seconds=60)
+        restored.restore(rows + [(3, 0.0, -100)], now=10)
+        self.assertFalse(restored.allow(1, now=10))
+        self.assertEqual(len(restored), 2)  # the row older than a window is dropped
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import asyncio
+import unittest
+
+from app.singleflight import SingleFlight
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_calls_share_one_run(self):
+        flights = SingleFlight()
+        gate = asyncio.Event()
+        calls = []
+
+        async def load():
+            calls.append(1)
+            await gate.wait()
+            return "card"
+
+        waiters = [asyncio.ensure_future(flights.do("k", load)) for _ in range(5)]
+        await asyncio.sleep(0)
+        gate.set()
+        self.assertEqual(await asyncio.gather(*waiters), ["card"] * 5)
+        self.assertEqual(len(calls), 1)
+        # finished flights are forgotten: the next call runs again
+        self.assertEqual(await flights.do("k", load), "card")
+        self.assertEqual(len(calls), 2)
+
+    async def test_errors_reach_every_waiter(self):
+        flights = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0)
+            raise ValueError("WB down")
+
+        results = await asyncio.gather(flights.do("k", fail), flights.do("k", fail), return_exceptions=True)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+    async def test_cancelled_caller_does_not_cancel_the_others(self):
+        flights = SingleFlight()
+        gate = asyncio.Event()
+
+        async def load():
+            await gate.wait()
+            return 42
+
+        first = asyncio.ensure_future(flights.do("k", load))
+        second = asyncio.ensure_future(flights.do("k", load))
+        await asyncio.sleep(0)
+        first.cancel()
+        gate.set()
+        self.assertEqual(await second, 42)
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+
+
+if __name__ == "__main__":
+    unittest.main()
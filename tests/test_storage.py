@@ -0,0 +1,158 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from app import codec
+from app.storage import Storage
+
+
+class StorageTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "bot.sqlite3")
+        self.storage = await self._connect()
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+        self.tmp.cleanup()
+
+    async def _connect(self, **kwargs) -> Storage:
+        kwargs.setdefault("compress_min_bytes", 64)
+        kwargs.setdefault("sweep_seconds", 0)
+        storage = Storage(self.path, **kwargs)
+        await storage.connect()
+        return storage
+
+    async def _reopen(self) -> None:
+        """A new instance: nothing in the memory tier, everything read from the table."""
+        await self.storage.close()
+        self.storage = await self._connect()
+
+
+class WriterTest(StorageTestCase):
+    async def test_values_survive_the_writer(self):
+        card = {"products": [{"id": 1, "name": "Платье " * 40, "root": 7}]}
+        values = {"small": {"a": 1}, "dict": card, "bytes": bytes(range(256)) * 4}
+        await asyncio.gather(*(self.storage.cache_set(k, v, ttl_seconds=60) for k, v in values.items()))
+        await self._reopen()
+        for key, value in values.items():
+            with self.subTest(key=key):
+                self.assertEqual(await self.storage.cache_get(key), value)
+        self.assertIsNone(await self.storage.cache_get("missing"))
+
+    async def test_failed_statement_does_not_sink_its_batch(self):
+        results = await asyncio.gather(
+            self.storage.cache_set("before", 1, ttl_seconds=60),
+            self.storage._write("INSERT INTO no_such_table VALUES (1)"),
+            self.storage.cache_set("after", 2, ttl_seconds=60),
+            return_exceptions=True,
+        )
+        self.assertIsInstance(results[1], sqlite3.OperationalError)
+        await self._reopen()
+        self.assertEqual(await self.storage.cache_get("before"), 1)
+        self.assertEqual(await self.storage.cache_get("after"), 2)
+
+    async def test_close_drains_pending_writes(self):
+        for i in range(50):
+            await self.storage._write("INSERT INTO price_history(nmid, ts) VALUES(?, ?)", (i, i), wait=False)
+        await self._reopen()
+        self.assertEqual(len(await self.storage.price_get_history(49)), 1)
+
+
+class RawJSONTest(StorageTestCase):
+    async def test_json_bytes_below_and_above_the_compression_threshold(self):
+        small = codec.RawJSON('{"products": [{"id": 2, "name": "Я"}]}'.encode("utf-8"))
+        card = {"products": [{"id": 1, "name": "Платье " * 40, "root": 7}]}
+        await self.storage.cache_set("small", small, ttl_seconds=60)
+        await self.storage.cache_set("big", codec.RawJSON.of(card), ttl_seconds=60)
+        # served from the memory tier as the parsed document
+        self.assertEqual(await self.storage.cache_get("small"), {"products": [{"id": 2, "name": "Я"}]})
+
+        await self._reopen()
+        self.assertEqual(await self.storage.cache_get("small"), {"products": [{"id": 2, "name": "Я"}]})
+        self.assertEqual(await self.storage.cache_get("big"), card)
+        cur = await self.storage.rdb.execute("SELECT value_json FROM cache WHERE key='small'")
+        (stored,) = await cur.fetchone()
+        await cur.close()
+        self.assertTrue(codec.is_compressed(stored))  # framed as JSON bytes, not a plain BLOB
+
+
+class SharedRateLimitTest(StorageTestCase):
+    async def test_limit_holds_across_processes(self):
+        await self.storage.close()
+        self.storage = await self._connect(process_index=0, process_count=2)
+        other = await self._connect(process_index=1, process_count=2)
+        try:
+            allowed = []
+            for storage in (self.storage, other, self.storage, other):
+                allowed.append(await storage.rate_limit_allow(1, window_seconds=60, max_requests=3))
+            self.assertEqual(allowed, [True, True, True, False])
+            self.assertTrue(await other.rate_limit_allow(2, window_seconds=60, max_requests=3))
+        finally:
+            await other.close()
+
+
+class SweepTest(StorageTestCase):
+    async def test_expired_rows_then_size_cap_by_last_access(self):
+        await self.storage.close()
+        self.storage = await self._connect(compress=False, cache_max_bytes=1000)
+        await self.storage.cache_set("gone", b"x" * 10, ttl_seconds=-10)
+        for i in range(10):
+            await self.storage.cache_set(f"k{i}", bytes([i]) * 200, ttl_seconds=60)
+        # k9 was read last, k0 first
+        await self.storage._write(
+            "UPDATE cache SET accessed_at=? WHERE key=?", [(1000 + i, f"k{i}") for i in range(10)], many=True
+        )
+
+        stats = await self.storage.sweep()
+        self.assertEqual((stats["expired"], stats["evicted"]), (1, 6))  # down to 90% of the cap
+        cur = await self.storage.rdb.execute("SELECT key FROM cache ORDER BY key")
+        self.assertEqual([k for (k,) in await cur.fetchall()], ["k6", "k7", "k8", "k9"])
+        await cur.close()
+        self.assertIsNone(await self.storage.cache_get("k0"))  # gone from the memory tier too
+
+    async def test_stale_grace_keeps_recently_expired_rows(self):
+        await self.storage.close()
+        self.storage = await self._connect(stale_grace_seconds=600)
+        await self.storage.cache_set("stale", 1, ttl_seconds=-10)
+        await self.storage.cache_set("old", 2, ttl_seconds=-1000)
+        self.assertEqual((await self.storage.sweep())["expired"], 1)
+        self.assertIsNotNone(await self.storage.cache_get_stale("stale"))
+        self.assertIsNone(await self.storage.cache_get_stale("old"))
+
+
+class PriceSnapshotTest(StorageTestCase):
+    async def _history(self, nmid):
+        return [(row["ts"], row["basic_u"], row["product_u"]) for row in await self.storage.price_get_history(nmid)]
+
+    async def test_only_changed_prices_are_written(self):
+        self.assertEqual(await self.storage.price_add_snapshots([(1, 200, 150), (2, None, 90)], ts=100), 2)
+        self.assertEqual(await self.storage.price_add_snapshots([(1, 200, 150), (2, None, 80)], ts=200), 1)
+        self.assertEqual(await self.storage.price_add_snapshots([(1, 200, 150)], ts=300), 0)
+        await self._reopen()
+
+        # the last-price map is seeded from the table after a restart
+        self.assertEqual(await self.storage.price_add_snapshots([(1, 200, 150), (2, None, 70)], ts=400), 1)
+        await self._reopen()
+        self.assertEqual(await self._history(1), [(100, 200, 150)])
+        self.assertEqual(await self._history(2), [(400, None, 70), (200, None, 80), (100, None, 90)])
+
+    async def test_shared_database_rechecks_the_latest_row(self):
+        await self.storage.close()
+        self.storage = await self._connect(process_index=0, process_count=2)
+        other = await self._connect(process_index=1, process_count=2)
+        try:
+            await self.storage.price_add_snapshots([(1, None, 100)], ts=100)
+            await other.price_add_snapshots([(1, None, 120)], ts=200)
+            # back to 100: differs from the latest row (written by the other process)
+            await self.storage.price_add_snapshots([(1, None, 100)], ts=300)
+            await other.price_add_snapshots([(1, None, 100)], ts=400)
+        finally:
+            await other.close()
+        self.assertEqual(await self._history(1), [(300, None, 100), (200, None, 120), (100, None, 100)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from app.singleflight import SingleFlight
+from app.storage import Storage
+from app.swr import SWRCache
+
+
+class SWRCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.storage = Storage(os.path.join(self.tmp.name, "bot.sqlite3"), compress=False, sweep_seconds=0)
+        await self.storage.connect()
+        self.swr = SWRCache(SingleFlight())
+        self.loads = []
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+        self.tmp.cleanup()
+
+    async def load(self, previous):
+        self.loads.append(previous)
+        await asyncio.sleep(0.01)
+        value = {"v": len(self.loads)}
+        await self.storage.cache_set("k", value, ttl_seconds=60)
+        return value
+
+    async def get(self, max_stale: int = 600):
+        return await self.swr.get_fresh(self.storage, "k", self.load, max_stale, beta=0)
+
+    async def test_missing_entry_is_loaded_once(self):
+        results = await asyncio.gather(self.get(), self.get(), self.get())
+        self.assertEqual(results, [({"v": 1}, True)] * 3)
+        self.assertEqual(self.loads, [None])
+        self.assertEqual(await self.get(), ({"v": 1}, True))
+        self.assertEqual(len(self.loads), 1)
+
+    async def test_stale_entry_is_served_while_one_refresh_runs(self):
+        await self.storage.cache_set("k", {"v": 0}, ttl_seconds=-10)
+        results = await asyncio.gather(self.get(), self.get())
+        self.assertEqual(results, [({"v": 0}, False)] * 2)
+        await self.swr.wait_refresh("k")
+        self.assertEqual(self.loads, [{"v": 0}])
+        self.assertEqual(await self.get(), ({"v": 1}, True))
+
+    async def test_too_old_entry_is_reloaded_inline(self):
+        await self.storage.cache_set("k", {"v": 0}, ttl_seconds=-100)
+        self.assertEqual(await self.get(max_stale=50), ({"v": 1}, True))
+        self.assertEqual(self.loads, [{"v": 0}])
+
+    async def test_failed_refresh_keeps_the_stale_value(self):
+        await self.storage.cache_set("k", {"v": 0}, ttl_seconds=-10)
+
+        async def fail(previous):
+            raise RuntimeError("WB down")
+
+        self.assertEqual(await self.swr.get_fresh(self.storage, "k", fail, 600, beta=0), ({"v": 0}, False))
+        await self.swr.wait_refresh("k")
+        self.assertEqual(await self.get(), ({"v": 0}, False))
+        await self.swr.wait_refresh("k")
+
+    async def test_bulk_refresh_is_the_only_load_of_its_keys(self):
+        await self.storage.cache_set("k", {"v": 0}, ttl_seconds=-100)
+        bulk_calls = []
+
+        async def bulk(keys):
+            bulk_calls.append(keys)
+            await asyncio.sleep(0.01)
+            await self.storage.cache_set("k", {"v": "bulk"}, ttl_seconds=60)
+            return {"k": {"v": "bulk"}}  # "gone" is not returned
+
+        self.swr.refresh_many(["k", "gone"], bulk)
+        self.swr.refresh_many(["k"], bulk)  # already being refreshed
+        # too old to serve stale / missing: both wait for the bulk refresh instead of loading
+        k, gone = await asyncio.gather(
+            self.get(max_stale=50),
+            self.swr.get_fresh(self.storage, "gone", self.load, 0, beta=0),
+            return_exceptions=True,
+        )
+        self.assertEqual(k, ({"v": "bulk"}, True))
+        self.assertIsInstance(gone, LookupError)
+        self.assertEqual(bulk_calls, [["k", "gone"]])
+        self.assertEqual(self.loads, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import unittest
+
+import httpx
+
+from app.wb_client import WBClient, extract_nmids
+
+
+class ExtractNmidsTest(unittest.TestCase):
+    def test_links_and_bare_numbers_in_order(self):
+        text = "сравни https://www.wildberries.ru/catalog/98892471/detail.aspx и 123456789, 98892471"
+        self.assertEqual(extract_nmids(text), [98892471, 123456789])
+
+    def test_number_at_end_of_sentence(self):
+        self.assertEqual(extract_nmids("арт 98892471."), [98892471])
+        self.assertEqual(extract_nmids("арт 98892471. И ещё 12345678!"), [98892471, 12345678])
+
+    def test_not_an_article_number(self):
+        for text in (
+            "звони 89161234567",
+            "звони +79161234567",
+            "звони 79161234567 вечером",
+            "цена 1500000 руб",
+            "цена 1500000₽",
+            "версия 1234567.89",
+            "файл 12345678.jpg",
+            "id abc12345678",
+        ):
+            with self.subTest(text=text):
+                self.assertEqual(extract_nmids(text), [])
+
+    def test_limit(self):
+        self.assertEqual(extract_nmids("1111111 2222222 3333333", limit=2), [1111111, 2222222])
+
+
+class FeedbacksPagedTest(unittest.IsolatedAsyncioTestCase):
+    TOTAL = 250  # reviews the product has
+    PAGE = 50
+
+    async def asyncSetUp(self):
+        self.requests = []  # skip of every page request
+        self.finished = []
+        self.ignore_skip = False
+        self.wb = WBClient(dest="-1", hedge_delay_s=5)
+        await self.wb.client.aclose()
+        self.wb.client = httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+
+    async def asyncTearDown(self):
+        await self.wb.aclose()
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        skip = 0 if self.ignore_skip else int(request.url.params.get("skip", 0))
+        take = int(request.url.params.get("take", self.TOTAL))
+        self.requests.append(skip)
+        # later pages answer sooner: the merge must still be in order
+        await asyncio.sleep(0.05 if skip == 0 else max(0.0, 0.03 - skip / 10000))
+        if skip > self.TOTAL:
+            await asyncio.sleep(1)  # past the end: should have been cancelled by then
+        items = [{"id": i, "text": f"review {i}"} for i in range(skip, min(skip + take, self.TOTAL))]
+        self.finished.append(skip)
+        return httpx.Response(200, content=json.dumps({"feedbacks": items}).encode())
+
+    async def fetch(self, max_items: int = 1000, concurrency: int = 8):
+        data = await self.wb.get_feedbacks_paged(1, page_size=self.PAGE, max_items=max_items, concurrency=concurrency)
+        return [item["id"] for item in data["feedbacks"]]
+
+    async def test_pages_are_merged_in_order_and_stop_at_a_short_page(self):
+        self.TOTAL = 230
+        self.assertEqual(await self.fetch(), list(range(230)))
+        # pages past the short one (skip 200) were cancelled, not waited for
+        self.assertTrue(all(skip <= 200 for skip in self.finished))
+        self.assertTrue(any(skip > 200 for skip in self.requests))
+
+    async def test_max_items(self):
+        self.assertEqual(await self.fetch(max_items=120, concurrency=2), list(range(120)))
+
+    async def test_ignored_skip_does_not_repeat_page_zero(self):
+        self.ignore_skip = True
+        self.assertEqual(await self.fetch(), list(range(self.PAGE)))
+        health = self.wb.feedback_health.dump()
+        self.assertTrue(any(v["fails"] for v in health.values()), health)
+
+
+if __name__ == "__main__":
+    unittest.main()